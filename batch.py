@@ -0,0 +1,183 @@
+'''Render every grammar project in a manifest, in parallel, without going
+through the web server.
+
+    python batch.py manifest.yaml --output-directory build
+
+The manifest is a YAML or JSON list of projects. Paths are relative to the
+manifest, and settings take the same names as the web form:
+
+    - name: kalini
+      markdown: [kalini/01-phonology.md, kalini/02-morphology.md]
+      lexicon: kalini/lexicon.csv
+      settings:
+        format: LaTeX PDF
+        grammarTitle: Kalini
+
+Each project is written to the output directory as its name followed by .pdf
+or .html, and a summary of throughput and latency is printed at the end.
+'''
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import time
+from concurrent.futures import as_completed
+
+import yaml
+
+from src.chapters import MarkdownFile
+from src.compression import variants
+from src.generate import generate, temp_directory
+from src.jobs import worker_pool
+from src.lexicon import LexiconFile
+from src.pandoc import pool as pandoc_pool
+
+# Settings used when a project leaves them out.
+DEFAULT_SETTINGS = {
+    'format': 'HTML',
+    'theme': 'Default',
+    'layout': 'A4',
+    'grammarTitle': 'My language',
+    'grammarSubtitle': 'A grammar',
+    'author': 'An author'
+}
+
+
+def read_manifest(path):
+    '''Return the projects in a manifest, with paths made absolute and
+    default settings filled in.'''
+    with open(path, encoding='utf-8') as f:
+        projects = yaml.safe_load(f) or []
+
+    manifest_directory = os.path.dirname(os.path.abspath(path))
+
+    for number, project in enumerate(projects):
+        project.setdefault('name', 'grammar-{0}'.format(number + 1))
+
+        markdown = project.get('markdown', [])
+        if isinstance(markdown, str):
+            markdown = [markdown]
+        project['markdown'] = [
+            os.path.join(manifest_directory, x) for x in markdown
+        ]
+
+        if project.get('lexicon'):
+            project['lexicon'] = os.path.join(manifest_directory,
+                                              project['lexicon'])
+
+        # Builds of the same project reuse its LaTeX cross-references.
+        settings = dict(DEFAULT_SETTINGS, project=project['name'])
+        settings.update(project.get('settings') or {})
+        project['settings'] = {
+            key: None if value is None else str(value)
+            for key, value in settings.items()
+        }
+
+    return projects
+
+
+def render_project(project, output_directory):
+    '''Render one project in a worker process. Returns the project's name, the
+    path of its output or None, the time taken in seconds and an error
+    message or None.'''
+    start = time.perf_counter()
+
+    try:
+        lexicon = project.get('lexicon')
+
+        filename = generate(
+            [MarkdownFile(x, name=x) for x in project['markdown']],
+            LexiconFile(lexicon) if lexicon else None, project['settings'])
+
+        artifact_path = os.path.join(temp_directory, filename)
+        output_path = os.path.join(
+            output_directory,
+            project['name'] + os.path.splitext(filename)[1])
+
+        # Keep only the artifact itself. Compressed variants are only used
+        # for downloads.
+        for path in variants(artifact_path)[1:]:
+            os.remove(path)
+        # The output directory may be on another filesystem.
+        shutil.move(artifact_path, output_path)
+
+        return project['name'], output_path, time.perf_counter() - start, None
+
+    except Exception as e:
+        error = str(type(e).__name__) + ': ' + str(e)
+        return project['name'], None, time.perf_counter() - start, error
+
+
+def percentile(values, fraction):
+    '''Return the value at the given fraction of the sorted values.'''
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def print_summary(results, elapsed, workers):
+    latencies = [seconds for _, _, seconds, _ in results]
+    failures = [(name, error) for name, _, _, error in results if error]
+
+    print()
+    print('Rendered {0} of {1} grammars in {2:.1f}s with {3} workers'.format(
+        len(results) - len(failures), len(results), elapsed, workers))
+
+    if latencies:
+        print('Throughput: {0:.2f} grammars/minute'.format(
+            len(results) / elapsed * 60))
+        print('Latency: min {0:.2f}s, median {1:.2f}s, p95 {2:.2f}s, '
+              'max {3:.2f}s'.format(
+                  min(latencies), statistics.median(latencies),
+                  percentile(latencies, 0.95), max(latencies)))
+
+    for name, error in failures:
+        print('Failed: {0}: {1}'.format(name, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('manifest')
+    parser.add_argument('--output-directory', default='build')
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=int(os.environ.get('CODA_WORKERS', os.cpu_count())),
+        help='number of worker processes')
+    arguments = parser.parse_args()
+
+    projects = read_manifest(arguments.manifest)
+    os.makedirs(arguments.output_directory, exist_ok=True)
+
+    # Start the pandoc servers before starting the workers, so that they are
+    # shared. Each worker keeps its parsed lexicons between projects, and
+    # the render, chapter and LaTeX format caches on disk are shared by all
+    # of them.
+    pandoc_pool.start()
+
+    start = time.perf_counter()
+    results = []
+
+    with worker_pool(arguments.workers) as executor:
+        futures = [
+            executor.submit(render_project, project,
+                            arguments.output_directory)
+            for project in projects
+        ]
+
+        for future in as_completed(futures):
+            name, output_path, seconds, error = future.result()
+            results.append((name, output_path, seconds, error))
+
+            print('{0}: {1} ({2:.2f}s)'.format(name, error or output_path,
+                                               seconds))
+
+    print_summary(results, time.perf_counter() - start, arguments.workers)
+
+    if any(error for _, _, _, error in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
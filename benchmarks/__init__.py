@@ -0,0 +1,19 @@
+import time
+
+
+def time_call(function, repeat):
+    '''Return the minimum and median wall-clock time of several calls to
+    function.'''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'repeat': repeat
+    }
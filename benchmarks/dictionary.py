@@ -0,0 +1,76 @@
+'''Measure the time and peak memory of building the HTML and LaTeX
+dictionaries, as a single string and streamed to a file.
+
+    python -m benchmarks.dictionary --rows 50000 200000
+'''
+import argparse
+import multiprocessing
+import resource
+import tempfile
+import time
+
+from benchmarks.synthetic import generate_lexicon
+from src.generate import (LEXICON_COLUMN_DEFAULTS, create_html_dictionary,
+                          create_latex_dictionary, iter_html_dictionary,
+                          iter_latex_dictionary)
+from src.lexicon import parse_lexicon
+
+BUILDERS = {
+    ('HTML', 'string'): create_html_dictionary,
+    ('LaTeX', 'string'): create_latex_dictionary,
+    ('HTML', 'stream'): iter_html_dictionary,
+    ('LaTeX', 'stream'): iter_latex_dictionary
+}
+
+
+def peak_rss():
+    '''Return the peak resident set size of this process in bytes.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(output_format, mode, rows, results):
+    '''Build one dictionary in a fresh process and report the elapsed time
+    and the growth in peak RSS caused by the build.'''
+    lexicon = parse_lexicon(
+        generate_lexicon(rows), LEXICON_COLUMN_DEFAULTS)
+    lexicon.groups()
+
+    builder = BUILDERS[(output_format, mode)]
+    baseline = peak_rss()
+    start = time.perf_counter()
+
+    with tempfile.TemporaryFile('w') as f:
+        if mode == 'string':
+            f.write(builder(lexicon, LEXICON_COLUMN_DEFAULTS))
+        else:
+            f.writelines(builder(lexicon, LEXICON_COLUMN_DEFAULTS))
+
+        size = f.tell()
+
+    results.put((time.perf_counter() - start, peak_rss() - baseline, size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[50000, 200000])
+    arguments = parser.parse_args()
+
+    for rows in arguments.rows:
+        for output_format, mode in sorted(BUILDERS):
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=measure,
+                args=(output_format, mode, rows, results))
+            process.start()
+            elapsed, rss, size = results.get()
+            process.join()
+
+            print('{0:>7} rows {1:<5} {2:<6}: {3:.3f}s, peak RSS +{4:.1f} MiB '
+                  '({5:.1f} MiB written)'.format(rows, output_format, mode,
+                                                 elapsed, rss / 2**20,
+                                                 size / 2**20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''Compare running the panflute filters as pandoc subprocess filters with
+running them in the server process.
+
+    python -m benchmarks.filter_pipeline --chapters 40
+'''
+import argparse
+import io
+import os
+
+import panflute as pf
+import pypandoc
+
+from benchmarks import time_call
+from benchmarks.synthetic import generate_grammar, generate_lexicon
+from filters import HTML as html_filter
+from filters.core import Timings
+from src import pandoc
+from src.generate import base_directory, convert_with_filter, READER_ARGUMENTS
+
+
+def subprocess_filter(markdown):
+    filter_path = os.path.join(base_directory, 'filters', 'HTML.py')
+    format, arguments = pandoc.process_arguments('md', READER_ARGUMENTS,
+                                                 pandoc.pandoc_version())
+
+    return pypandoc.convert_text(
+        markdown,
+        format=format,
+        to='html',
+        extra_args=arguments,
+        filters=[filter_path])
+
+
+def in_process_filter(markdown):
+    return convert_with_filter(
+        markdown, 'html', html_filter, reader_arguments=READER_ARGUMENTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chapters', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    arguments = parser.parse_args()
+
+    for chapters in sorted({1, arguments.chapters}):
+        markdown = '\n\n'.join(
+            generate_grammar(
+                chapters=chapters, lexicon_string=generate_lexicon(500)))
+
+        before = time_call(lambda: subprocess_filter(markdown),
+                           arguments.repeat)['min']
+        after = time_call(lambda: in_process_filter(markdown),
+                          arguments.repeat)['min']
+
+        print('{0:>3} chapters ({1:>8} bytes): subprocess {2:.3f}s, '
+              'in-process {3:.3f}s'.format(chapters, len(markdown), before,
+                                           after))
+
+        # Break the filter's own cost down by element type.
+        ast = pandoc.convert_text(
+            markdown, 'json', 'md', extra_args=READER_ARGUMENTS)
+        timings = Timings()
+        html_filter.main(pf.load(io.StringIO(ast)), timings=timings)
+
+        for name, count, seconds in timings.items():
+            print('    {0:<12} {1:>7} elements {2:.3f}s'.format(
+                name, count, seconds))
+
+
+if __name__ == '__main__':
+    main()
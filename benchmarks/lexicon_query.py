@@ -0,0 +1,50 @@
+'''Time exact lookups and prefix searches on an indexed lexicon, as served by
+the /lexicons endpoints.
+
+    python -m benchmarks.lexicon_query --lexicon-rows 100000
+'''
+import argparse
+import random
+import time
+
+from benchmarks.synthetic import generate_lexicon, lexicon_words
+from src.lexicon import LEXICON_COLUMN_DEFAULTS, LexiconStore
+
+
+def time_queries(name, query, arguments):
+    start = time.perf_counter()
+    for argument in arguments:
+        query(argument)
+    elapsed = time.perf_counter() - start
+
+    print('{0:<14}: {1:>8.2f} us/query'.format(
+        name, elapsed / len(arguments) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lexicon-rows', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=10000)
+    arguments = parser.parse_args()
+
+    lexicon_string = generate_lexicon(arguments.lexicon_rows)
+
+    store = LexiconStore()
+    start = time.perf_counter()
+    lexicon = store.get(store.add(lexicon_string, LEXICON_COLUMN_DEFAULTS))
+    print('{0} entries parsed and indexed in {1:.3f}s'.format(
+        len(lexicon), time.perf_counter() - start))
+
+    random.seed(0)
+    words = random.choices(lexicon_words(lexicon_string), k=arguments.queries)
+    local_words = [lexicon[word].local_word for word in words]
+
+    time_queries('lookup word', lexicon.get, words)
+    time_queries('lookup local', lexicon.get_local, local_words)
+    time_queries('search word', lambda x: lexicon.search(x[:2]), words)
+    time_queries('search local',
+                 lambda x: lexicon.search(x[:2], field='local'), local_words)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''Time load_words_from_lexicon on documents with many lexicon references,
+against the previous replace-per-match implementation.
+
+    python -m benchmarks.lexicon_substitution --references 10000 20000
+'''
+import argparse
+import random
+import re
+import string
+import time
+
+from benchmarks.synthetic import generate_lexicon, lexicon_words, make_word
+from src.generate import (DEFINITION_TEMPLATE, LEXICON_COLUMN_DEFAULTS,
+                          convert_lexicon, load_words_from_lexicon)
+
+
+def naive_substitution(html, lexicon_string, lexicon_columns):
+    '''The original implementation: one str.replace over the whole document
+    per match, rebuilding the template each time.'''
+    lexicon = convert_lexicon(lexicon_string, lexicon_columns)
+
+    for match in re.findall(r'{{[a-z]*}}', html, re.I):
+        word = match[2:-2]
+        try:
+            definition_HTML = string.Template(DEFINITION_TEMPLATE).substitute(
+                word=word,
+                local_word=lexicon[word]['local_word'],
+                definition=lexicon[word]['definition'],
+                part=lexicon[word]['part_of_speech'])
+            html = html.replace(match, definition_HTML)
+        except KeyError:
+            pass
+
+    return html
+
+
+def generate_html(references, words, seed=0):
+    '''Return an HTML string containing the given number of lexicon
+    references, as left by the HTML filter.'''
+    rng = random.Random(seed)
+    paragraphs = []
+
+    for _ in range(references):
+        filler = ' '.join(make_word(rng) for _ in range(10))
+        paragraphs.append('<p>{0} {{{{{1}}}}}</p>'.format(
+            filler, rng.choice(words)))
+
+    return '\n'.join(paragraphs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--references', type=int, nargs='+', default=[1000, 10000, 20000])
+    parser.add_argument('--lexicon-rows', type=int, default=2000)
+    arguments = parser.parse_args()
+
+    lexicon = generate_lexicon(arguments.lexicon_rows)
+    words = lexicon_words(lexicon)
+
+    for references in arguments.references:
+        html = generate_html(references, words)
+
+        start = time.perf_counter()
+        after = load_words_from_lexicon(html, lexicon, LEXICON_COLUMN_DEFAULTS)
+        single_pass = time.perf_counter() - start
+
+        start = time.perf_counter()
+        before = naive_substitution(html, lexicon, LEXICON_COLUMN_DEFAULTS)
+        naive = time.perf_counter() - start
+
+        assert before == after
+
+        print('{0:>6} references ({1:>9} bytes): replace per match {2:.3f}s, '
+              'single pass {3:.3f}s'.format(references, len(html), naive,
+                                            single_pass))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''Compare the size of HTML output, and the time to produce it, with lexicon
+definitions inlined at every reference and written once in a lookup table.
+
+    python -m benchmarks.lexicon_table --references 1000 10000
+'''
+import argparse
+import gzip
+import time
+
+from benchmarks.lexicon_substitution import generate_html
+from benchmarks.synthetic import generate_lexicon, lexicon_words
+from src.generate import (LEXICON_COLUMN_DEFAULTS, link_words_to_lexicon,
+                          load_words_from_lexicon)
+from src.lexicon import load_lexicon
+
+MODES = [
+    ('inline', load_words_from_lexicon),
+    ('table', link_words_to_lexicon),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--references', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--lexicon-rows', type=int, default=2000)
+    arguments = parser.parse_args()
+
+    lexicon_string = generate_lexicon(arguments.lexicon_rows)
+    lexicon = load_lexicon(lexicon_string, LEXICON_COLUMN_DEFAULTS)
+    words = lexicon_words(lexicon_string)
+
+    for references in arguments.references:
+        html = '<html><body>\n{0}\n</body></html>'.format(
+            generate_html(references, words))
+
+        for name, substitute in MODES:
+            start = time.perf_counter()
+            output = substitute(html, lexicon, LEXICON_COLUMN_DEFAULTS)
+            elapsed = time.perf_counter() - start
+
+            encoded = output.encode('utf-8')
+
+            print('{0:>6} references {1:<6}: {2:.3f}s, {3:>6.2f} MiB, '
+                  '{4:>6.2f} MiB gzipped'.format(
+                      references, name, elapsed, len(encoded) / 2**20,
+                      len(gzip.compress(encoded)) / 2**20))
+
+
+if __name__ == '__main__':
+    main()
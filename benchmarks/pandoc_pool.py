@@ -0,0 +1,58 @@
+'''Compare the latency of converting a document by starting a pandoc process
+for each conversion with sending it to a pool of warm pandoc servers. Needs
+pandoc 3.0 or later, which has a server mode.
+
+    python -m benchmarks.pandoc_pool --chapters 40
+'''
+import argparse
+
+from benchmarks import time_call
+from benchmarks.synthetic import generate_grammar, generate_lexicon
+from src.pandoc import PandocPool, run_pandoc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chapters', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--servers', type=int, default=2)
+    arguments = parser.parse_args()
+
+    pool = PandocPool(size=arguments.servers)
+    if pool.start() == 0:
+        print('Could not start a pandoc server. Is pandoc 3.0 installed?')
+        return
+
+    try:
+        for chapters in sorted({1, arguments.chapters}):
+            markdown = '\n\n'.join(
+                generate_grammar(
+                    chapters=chapters, lexicon_string=generate_lexicon(500)))
+            ast = run_pandoc('md', 'json', [], source=markdown)
+
+            conversions = [
+                ('read', markdown, 'json', 'md'),
+                ('write', ast, 'html', 'json'),
+            ]
+
+            for name, source, to, format in conversions:
+                before = time_call(
+                    lambda: run_pandoc(format, to, [], source=source),
+                    arguments.repeat)['median']
+                after = time_call(
+                    lambda: pool.convert_text(source, to, format),
+                    arguments.repeat)['median']
+
+                print('{0:>3} chapters ({1:>8} bytes) {2:<5}: process '
+                      '{3:.3f}s, server {4:.3f}s'.format(
+                          chapters, len(source), name, before, after))
+
+        if pool.fallbacks:
+            print('Warning: {0} conversions fell back to pandoc '
+                  'processes'.format(pool.fallbacks))
+    finally:
+        pool.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+'''Run the benchmark suite on a synthetic grammar, timing the renderers, the
+filters and the lexicon functions individually. Results are saved as JSON,
+and can be compared against an earlier run to catch regressions:
+
+    python -m benchmarks.run --output baseline.json
+    python -m benchmarks.run --baseline baseline.json
+
+The comparison exits with a non-zero status if any case is slower than its
+baseline by more than the tolerance.
+'''
+import argparse
+import fnmatch
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import panflute as pf
+import pypandoc
+
+from benchmarks import time_call
+from benchmarks.lexicon_substitution import generate_html
+from benchmarks.synthetic import (generate_grammar, generate_lexicon,
+                                  lexicon_words)
+from filters import HTML as html_filter
+from filters import LaTeX as latex_filter
+from src import generate, pandoc
+from src.cache import RenderCache
+from src.generate import (LEXICON_COLUMN_DEFAULTS, READER_ARGUMENTS,
+                          create_html_dictionary, create_latex_dictionary,
+                          generate_HTML, generate_latex,
+                          load_words_from_lexicon)
+from src.lexicon import parse_lexicon
+
+# Allowed slowdown against the baseline before a case counts as a regression,
+# as a fraction of the baseline's median.
+DEFAULT_TOLERANCE = 0.1
+
+
+class Grammar:
+    '''The synthetic inputs shared by every case.'''
+
+    def __init__(self, arguments):
+        self.lexicon_string = generate_lexicon(arguments.lexicon_rows)
+        self.lexicon = parse_lexicon(self.lexicon_string,
+                                     LEXICON_COLUMN_DEFAULTS)
+        self.chapters = generate_grammar(
+            chapters=arguments.chapters,
+            paragraphs=arguments.paragraphs,
+            lexicon_string=self.lexicon_string,
+            reference_rate=arguments.reference_rate,
+            examples=arguments.examples,
+            gloss_words=arguments.gloss_words,
+            rules=arguments.rules)
+        self.markdown = '\n\n'.join(self.chapters)
+        self.references = generate_html(
+            sum(x.count('`') // 2 for x in self.chapters),
+            lexicon_words(self.lexicon_string))
+        self._ast = None
+
+    def ast(self):
+        '''Return the grammar as a pandoc JSON AST string, read on first
+        use.'''
+        if self._ast is None:
+            self._ast = pandoc.convert_text(
+                self.markdown,
+                'json',
+                format='md',
+                extra_args=READER_ARGUMENTS)
+
+        return self._ast
+
+
+def run_filter(filter_module, ast):
+    return filter_module.main(pf.load(io.StringIO(ast)))
+
+
+def render(renderer, grammar, scratch):
+    '''Render the grammar with empty caches, then remove the artifact.'''
+    generate.chapter_cache = RenderCache(
+        tempfile.mkdtemp(dir=scratch), generate.base_directory)
+
+    filename = renderer(grammar.chapters, grammar.lexicon_string)
+    artifact_path = os.path.join(generate.temp_directory, filename)
+
+    for suffix in ['', '.gz', '.br']:
+        if os.path.exists(artifact_path + suffix):
+            os.remove(artifact_path + suffix)
+
+
+def cases(grammar, scratch):
+    '''Return the benchmark cases as a list of (name, function) pairs.'''
+    columns = LEXICON_COLUMN_DEFAULTS
+
+    return [
+        ('lexicon.parse',
+         lambda: parse_lexicon(grammar.lexicon_string, columns)),
+        ('lexicon.html_dictionary',
+         lambda: create_html_dictionary(grammar.lexicon, columns)),
+        ('lexicon.latex_dictionary',
+         lambda: create_latex_dictionary(grammar.lexicon, columns)),
+        ('lexicon.substitution',
+         lambda: load_words_from_lexicon(grammar.references, grammar.lexicon,
+                                         columns)),
+        ('filters.html', lambda: run_filter(html_filter, grammar.ast())),
+        ('filters.latex', lambda: run_filter(latex_filter, grammar.ast())),
+        ('generate.html', lambda: render(generate_HTML, grammar, scratch)),
+        ('generate.latex', lambda: render(generate_latex, grammar, scratch)),
+    ]
+
+
+def run(arguments):
+    '''Run every selected case and return the results as a dictionary. Cases
+    which fail, e.g. because pandoc or xelatex is not installed, are recorded
+    with their error instead of timings.'''
+    grammar = Grammar(arguments)
+    scratch = tempfile.mkdtemp()
+    results = {}
+
+    try:
+        for name, function in cases(grammar, scratch):
+            if not any(
+                    fnmatch.fnmatch(name, pattern)
+                    for pattern in arguments.only):
+                continue
+
+            try:
+                results[name] = time_call(function, arguments.repeat)
+                print('{0:<26} median {1:.4f}s, min {2:.4f}s'.format(
+                    name, results[name]['median'], results[name]['min']))
+            except Exception as e:
+                results[name] = {
+                    'error': str(type(e).__name__) + ': ' + str(e)
+                }
+                print('{0:<26} failed: {1}'.format(name,
+                                                   results[name]['error']))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    try:
+        pandoc_version = pypandoc.get_pandoc_version()
+    except OSError:
+        pandoc_version = None
+
+    return {
+        'parameters': {
+            'chapters': arguments.chapters,
+            'paragraphs': arguments.paragraphs,
+            'examples': arguments.examples,
+            'gloss_words': arguments.gloss_words,
+            'rules': arguments.rules,
+            'reference_rate': arguments.reference_rate,
+            'lexicon_rows': arguments.lexicon_rows
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pandoc': pandoc_version
+        },
+        'markdown_bytes': len(grammar.markdown),
+        'results': results
+    }
+
+
+def compare(report, baseline, tolerance):
+    '''Print each case's median against the baseline's, and return the names
+    of the cases which regressed.'''
+    if report['parameters'] != baseline['parameters']:
+        print('Warning: the baseline was run with different parameters: ' +
+              json.dumps(baseline['parameters']))
+
+    regressions = []
+
+    for name, result in sorted(report['results'].items()):
+        previous = baseline['results'].get(name)
+        if previous is None or 'median' not in previous or (
+                'median' not in result):
+            continue
+
+        ratio = result['median'] / previous['median']
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+
+        print('{0:<26} {1:.4f}s -> {2:.4f}s ({3:+.1%}){4}'.format(
+            name, previous['median'], result['median'], ratio - 1,
+            '  REGRESSION' if regressed else ''))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--chapters', type=int, default=10)
+    parser.add_argument('--paragraphs', type=int, default=10)
+    parser.add_argument(
+        '--examples',
+        type=int,
+        default=3,
+        help='maximum number of (@) examples per section')
+    parser.add_argument(
+        '--gloss-words',
+        type=int,
+        default=1,
+        help='number of glossed words per example')
+    parser.add_argument(
+        '--rules', type=int, default=1, help='number of (*) rules per section')
+    parser.add_argument(
+        '--reference-rate',
+        type=float,
+        default=0.1,
+        help='fraction of prose words which are lexicon references')
+    parser.add_argument('--lexicon-rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--only',
+        nargs='+',
+        default=['*'],
+        help='run only the cases matching these patterns, e.g. lexicon.*')
+    parser.add_argument('--output', help='save the results to this file')
+    parser.add_argument(
+        '--baseline', help='compare with the results in this file')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help='allowed slowdown against the baseline, e.g. 0.1 for 10%%')
+    arguments = parser.parse_args()
+
+    report = run(arguments)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(report, baseline, arguments.tolerance)
+        if regressions:
+            print('Regressions: ' + ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
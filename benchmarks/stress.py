@@ -0,0 +1,84 @@
+'''Render many PDF and HTML grammars at once, in threads and in worker
+processes, and check that no render interferes with another.
+
+    python -m benchmarks.stress --renders 16
+'''
+import argparse
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from benchmarks.synthetic import generate_grammar, generate_lexicon
+from src import generate
+from src.compression import variants
+from src.generate import render, temp_directory
+
+
+def render_one(number):
+    '''Render a small grammar whose title identifies the render. PDF and HTML
+    renders alternate.'''
+    lexicon = generate_lexicon(200, seed=number)
+    chapters = generate_grammar(
+        chapters=3, paragraphs=3, lexicon_string=lexicon, seed=number)
+
+    settings = {
+        'format': 'HTML' if number % 2 else 'LaTeX PDF',
+        'theme': 'Default',
+        'layout': 'A4',
+        'grammarTitle': 'Stress test {0}'.format(number),
+        'grammarSubtitle': 'A grammar',
+        'author': 'Coda'
+    }
+
+    return number, settings['format'], render(chapters, lexicon, settings)
+
+
+def check(results, scratch_directory):
+    '''Check that every render produced its own artifact and removed its
+    scratch directory.'''
+    filenames = [filename for _, _, filename in results]
+    assert len(set(filenames)) == len(filenames), 'Artifact names collided'
+
+    for number, output_format, filename in results:
+        path = os.path.join(temp_directory, filename)
+        assert os.path.exists(path), 'Missing artifact ' + filename
+
+        if output_format == 'HTML':
+            with open(path, encoding='utf-8') as f:
+                assert 'Stress test {0}<'.format(number) in f.read(), (
+                    'Artifact {0} has the wrong title'.format(filename))
+
+        for variant_path in variants(path):
+            os.remove(variant_path)
+
+    assert os.listdir(scratch_directory) == [], (
+        'Scratch directories were left behind')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--renders', type=int, default=16)
+    arguments = parser.parse_args()
+
+    # Give the renders a scratch directory of their own, so that other users
+    # of temp/jobs do not affect the check. Worker processes are forked after
+    # this is set, so they use it too.
+    scratch_directory = tempfile.mkdtemp(
+        prefix='stress-', dir=generate.scratch_directory)
+    generate.scratch_directory = scratch_directory
+
+    for executor_class in [ThreadPoolExecutor, ProcessPoolExecutor]:
+        with executor_class(max_workers=arguments.renders) as executor:
+            results = list(
+                executor.map(render_one, range(arguments.renders)))
+
+        check(results, scratch_directory)
+
+        print('{0}: {1} concurrent renders OK'.format(
+            executor_class.__name__, arguments.renders))
+
+    os.rmdir(scratch_directory)
+
+
+if __name__ == '__main__':
+    main()
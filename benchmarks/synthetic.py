@@ -0,0 +1,108 @@
+import random
+import string
+
+GLOSSES = ['1SG', '2SG', '3SG', 'PL', 'PST', 'FUT', 'NEG', 'ACC', 'GEN', 'LOC']
+
+PARTS_OF_SPEECH = ['noun', 'verb', 'adjective', 'adverb', 'particle']
+
+LEXICON_HEADER = 'Word,Local,Pronunciation,Part of speech,Notes,Definition'
+
+
+def make_word(rng, length=None):
+    '''Return a random lower-case word.'''
+    length = length or rng.randint(3, 9)
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def generate_lexicon(rows, seed=0):
+    '''Return a lexicon CSV string with the given number of rows, using the
+    default column layout.'''
+    rng = random.Random(seed)
+    lines = [LEXICON_HEADER]
+
+    for _ in range(rows):
+        lines.append(','.join([
+            make_word(rng),
+            make_word(rng),
+            make_word(rng),
+            rng.choice(PARTS_OF_SPEECH),
+            '',
+            ' '.join(make_word(rng) for _ in range(rng.randint(1, 6)))
+        ]))
+
+    return '\n'.join(lines)
+
+
+def lexicon_words(lexicon_string):
+    '''Return the words defined in a lexicon CSV string.'''
+    return [line.split(',', 1)[0] for line in lexicon_string.split('\n')[1:]]
+
+
+def generate_chapter(rng,
+                     number,
+                     paragraphs,
+                     words,
+                     sentence_words=40,
+                     reference_rate=0.1,
+                     examples=3,
+                     gloss_words=1,
+                     rules=1):
+    '''Return a single chapter of Coda markdown. Each section has a paragraph
+    of prose in which roughly reference_rate of the words are inline lexicon
+    references, an example list of between one and examples interlinear
+    examples with gloss_words glossed words each, and the given number of
+    (*) rules.'''
+    lines = ['# Chapter {0}'.format(number), '']
+
+    for paragraph in range(paragraphs):
+        lines.append('## Section {0}.{1}'.format(number, paragraph + 1))
+        lines.append('')
+
+        # Prose with inline lexicon references.
+        sentence = []
+        for _ in range(sentence_words):
+            if words and rng.random() < reference_rate:
+                sentence.append('`{0}`'.format(rng.choice(words)))
+            else:
+                sentence.append(make_word(rng))
+        lines.append(' '.join(sentence) + '.')
+        lines.append('')
+
+        # An interlinear example list.
+        if examples > 0:
+            for _ in range(rng.randint(1, examples)):
+                targets = []
+                glosses = []
+                for _ in range(gloss_words):
+                    targets.append('-'.join(
+                        make_word(rng, 3) for _ in range(2)))
+                    glosses.append('{0}-{1}'.format(
+                        make_word(rng, 4), rng.choice(GLOSSES)))
+                lines.append('(@) {0}, {1}, {2}'.format(
+                    ' '.join(targets), ' '.join(glosses), make_word(rng)))
+            lines.append('')
+
+        # Rules.
+        for rule in range(rules):
+            lines.append('(*) Rule {0}.{1}.{2}: {3}'.format(
+                number, paragraph + 1, rule + 1, ' '.join(
+                    make_word(rng) for _ in range(8))))
+            lines.append('')
+
+    return '\n'.join(lines)
+
+
+def generate_grammar(chapters=10,
+                     paragraphs=10,
+                     lexicon_string='',
+                     seed=0,
+                     **chapter_options):
+    '''Return a list of markdown chapter strings. Other keyword arguments are
+    passed to generate_chapter.'''
+    rng = random.Random(seed)
+    words = lexicon_words(lexicon_string) if lexicon_string else []
+
+    return [
+        generate_chapter(rng, number + 1, paragraphs, words, **chapter_options)
+        for number in range(chapters)
+    ]
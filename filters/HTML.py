@@ -1,5 +1,12 @@
 import panflute as pf
 import string
+import sys
+
+try:
+    from .core import LinguisticFilter
+except ImportError:
+    # Run directly as a pandoc filter.
+    from core import LinguisticFilter
 
 EXAMPLE_TEMPLATE = '''
 <div class="example-target">$target</div>
@@ -22,6 +29,10 @@ RULE_TEMPLATE = '''
 </div>
 '''
 
+EXAMPLE = string.Template(EXAMPLE_TEMPLATE)
+EXAMPLE_BLOCK = string.Template(EXAMPLE_BLOCK_TEMPLATE)
+RULE = string.Template(RULE_TEMPLATE)
+
 
 def strip_example(example):
     '''Takes a full example string, including hyphens and null morphemes, and
@@ -29,66 +40,39 @@ def strip_example(example):
     return example.replace('-', '').replace('ø', '')
 
 
-def create_example(number, elem):
+def create_example(number, examples):
     '''Create an example HTML block.'''
-    examples = []
-
-    # For each example in the list, extract each part of the example.
-    # Then substitute the parts into the example template.
-    for example in elem.content:
-        content = [line.strip() for line in pf.stringify(example).split(',')]
-
-        parts = {}
-        parts['target'] = strip_example(content[0])
-        parts['expanded_target'] = content[0]
-        parts['gloss'] = content[1]
-        parts['native'] = content[2]
-
-        example_HTML = string.Template(EXAMPLE_TEMPLATE).substitute(parts)
-        examples.append(example_HTML)
+    examples_HTML = [
+        EXAMPLE.substitute(
+            target=strip_example(target),
+            expanded_target=target,
+            gloss=gloss,
+            native=native) for target, gloss, native in examples
+    ]
 
     # Substitute examples into the block div.
-    block_settings = {'number': number, 'examples': '<br>'.join(examples)}
-    example_block = string.Template(EXAMPLE_BLOCK_TEMPLATE)
-
-    return pf.RawBlock(example_block.substitute(block_settings), format='html')
+    return pf.RawBlock(
+        EXAMPLE_BLOCK.substitute(
+            number=number, examples='<br>'.join(examples_HTML)),
+        format='html')
 
 
-def create_rule(elem):
+def create_rule(name, definition):
     '''Create a rule HTML block.'''
-    name, definition = pf.stringify(elem)[3:].split(':')
+    return pf.RawBlock(
+        RULE.substitute(name=name, definition=definition), format='html')
 
-    substitutions = dict(name=name, definition=definition)
-    rule_HTML = string.Template(RULE_TEMPLATE).substitute(substitutions)
 
-    return pf.RawBlock(rule_HTML, format='html')
-
-
-def create_definition(elem):
+def create_definition(word):
     '''Surround language words in double brackets, for later processing.'''
-    word = pf.stringify(elem)
-
     return pf.RawInline('{{' + word + '}}')
 
 
-def linguistic_features(elem, doc):
-    ''' Detect individual syntax features and delegate to their creation
-    functions.'''
-    try:
-        if type(elem) == pf.OrderedList and elem.style == 'Example':
-            return create_example(elem.start, elem)
-        elif type(elem) == pf.Para and pf.stringify(elem).startswith('(*)'):
-            return create_rule(elem)
-        elif type(elem) == pf.Code:
-            return create_definition(elem)
-        else:
-            return elem
-    except:
-        return elem
-
-
-def main(doc=None):
-    return pf.run_filter(linguistic_features, doc=doc)
+linguistic_filter = LinguisticFilter(sys.modules[__name__])
+
+
+def main(doc=None, timings=None):
+    return linguistic_filter.run(doc=doc, timings=timings)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,12 @@
 import panflute as pf
 import string
+import sys
+
+try:
+    from .core import LinguisticFilter
+except ImportError:
+    # Run directly as a pandoc filter.
+    from core import LinguisticFilter
 
 EXAMPLE_TEMPLATE = '''
 \\exdisplay
@@ -25,70 +32,44 @@ RULE_TEMPLATE = '''
 '''
 
 
-def create_example(number, elem):
-    '''Create an example LaTeX block.'''
-    examples = []
-
-    # For each example in the list, extract each part of the example.
-    # Then substitute the parts into the example template.
-    for example in elem.content:
-        content = [line.strip() for line in pf.stringify(example).split(',')]
-
-        parts = {}
-        parts['target'] = content[0]
-
-        # Format the gloss in small caps
-        parts['gloss'] = ' '.join(
-            ['\\textsc{' + x + '}' for x in content[1].split(' ')])
+EXAMPLE = string.Template(EXAMPLE_TEMPLATE)
+EXAMPLE_BLOCK = string.Template(EXAMPLE_BLOCK_TEMPLATE)
+RULE = string.Template(RULE_TEMPLATE)
 
-        parts['native'] = content[2]
 
-        example_LaTeX = string.Template(EXAMPLE_TEMPLATE).substitute(parts)
-        examples.append(example_LaTeX)
+def create_example(number, examples):
+    '''Create an example LaTeX block.'''
+    examples_LaTeX = [
+        EXAMPLE.substitute(
+            target=target,
+            # Format the gloss in small caps
+            gloss=' '.join('\\textsc{' + x + '}' for x in gloss.split(' ')),
+            native=native) for target, gloss, native in examples
+    ]
 
     # Substitute examples into the block div.
-    block_settings = {'examples': '\n'.join(examples)}
-    example_block = string.Template(EXAMPLE_BLOCK_TEMPLATE)
-
     return pf.RawBlock(
-        example_block.substitute(block_settings), format='latex')
-
+        EXAMPLE_BLOCK.substitute(examples='\n'.join(examples_LaTeX)),
+        format='latex')
 
-def create_rule(elem):
-    '''Create a rule HTML block.'''
-    name, definition = pf.stringify(elem)[3:].split(':')
 
-    substitutions = dict(name=name, definition=definition.strip())
-    rule_LaTeX = string.Template(RULE_TEMPLATE).substitute(substitutions)
-    pf.debug(rule_LaTeX)
-    return pf.RawBlock(rule_LaTeX, format='latex')
+def create_rule(name, definition):
+    '''Create a rule LaTeX block.'''
+    return pf.RawBlock(
+        RULE.substitute(name=name, definition=definition.strip()),
+        format='latex')
 
 
-def create_definition(elem):
+def create_definition(word):
     '''Italicise language words.'''
-    word = pf.stringify(elem)
-
     return pf.RawInline('\\textit{' + word + '}', format='latex')
 
 
-def linguistic_features(elem, doc):
-    ''' Detect individual syntax features and delegate to their creation
-    functions.'''
-    try:
-        if type(elem) == pf.OrderedList and elem.style == 'Example':
-            return create_example(elem.start, elem)
-        elif type(elem) == pf.Para and pf.stringify(elem).startswith('(*)'):
-            return create_rule(elem)
-        elif type(elem) == pf.Code:
-            return create_definition(elem)
-        else:
-            return elem
-    except:
-        return elem
-
-
-def main(doc=None):
-    return pf.run_filter(linguistic_features, doc=doc)
+linguistic_filter = LinguisticFilter(sys.modules[__name__])
+
+
+def main(doc=None, timings=None):
+    return linguistic_filter.run(doc=doc, timings=timings)
 
 
 if __name__ == '__main__':
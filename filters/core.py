@@ -0,0 +1,112 @@
+import time
+from functools import partial
+
+import panflute as pf
+
+RULE_PREFIX = '(*)'
+
+
+class Timings:
+    '''The number of elements of each type handled by a filter, and the time
+    spent handling them.'''
+
+    def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+
+    def add(self, name, seconds):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    def items(self):
+        '''Return a list of (type name, count, seconds) tuples, slowest
+        first.'''
+        return sorted(
+            ((name, self.counts[name], self.seconds[name])
+             for name in self.counts),
+            key=lambda x: x[2],
+            reverse=True)
+
+
+def is_rule(elem):
+    '''Return True if a paragraph is a rule, i.e. starts with (*). Only the
+    first inline element is checked, rather than the whole paragraph.'''
+    return (len(elem.content) > 0 and type(elem.content[0]) == pf.Str
+            and elem.content[0].text.startswith(RULE_PREFIX))
+
+
+def parse_example(example):
+    '''Split an example list item into its target, gloss and native
+    translation.'''
+    content = [line.strip() for line in pf.stringify(example).split(',')]
+
+    return content[0], content[1], content[2]
+
+
+def parse_rule(elem):
+    '''Split a rule paragraph into its name and definition.'''
+    name, definition = pf.stringify(elem)[len(RULE_PREFIX):].split(':')
+
+    return name, definition
+
+
+class LinguisticFilter:
+    '''Finds the linguistic features of Coda's extended markdown (example
+    lists, rules and lexicon references) and converts them with a backend
+    for the output format.
+
+    A backend is a module with three functions, each returning a panflute
+    element:
+
+        create_example(number, examples), where examples is a list of
+            (target, gloss, native) tuples
+        create_rule(name, definition)
+        create_definition(word)
+
+    Elements are dispatched on their type, so elements which can never be a
+    feature cost a single dictionary lookup.'''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+        self._handlers = {
+            pf.OrderedList: self.example,
+            pf.Para: self.rule,
+            pf.Code: self.definition
+        }
+
+    def example(self, elem):
+        if elem.style == 'Example':
+            return self.backend.create_example(
+                elem.start, [parse_example(x) for x in elem.content])
+
+    def rule(self, elem):
+        if is_rule(elem):
+            return self.backend.create_rule(*parse_rule(elem))
+
+    def definition(self, elem):
+        return self.backend.create_definition(pf.stringify(elem))
+
+    def action(self, elem, doc, timings=None):
+        handler = self._handlers.get(type(elem))
+        if handler is None:
+            return elem
+
+        start = time.perf_counter()
+        try:
+            result = handler(elem)
+        except Exception:
+            # Leave malformed features untouched.
+            result = None
+        finally:
+            if timings is not None:
+                timings.add(type(elem).__name__, time.perf_counter() - start)
+
+        return elem if result is None else result
+
+    def run(self, doc=None, timings=None):
+        '''Filter a document, or read one from stdin and write the result to
+        stdout if none is given. If a Timings is given, the time spent on
+        each element type is added to it. The filter keeps no state between
+        runs, so one filter can run in several threads at once.'''
+        return pf.run_filter(partial(self.action, timings=timings), doc=doc)
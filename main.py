@@ -1,12 +1,22 @@
-from flask import Flask, request, send_file, url_for, after_this_request
+from flask import (Flask, request, send_file, url_for, after_this_request,
+                   jsonify)
 import os
-import pypandoc
-import io
 import sys
 
 sys.stdout = sys.stderr
 
-from src.generate import generate
+from src.generate import (read_lexicon_columns, render_cache,
+                          scratch_directory, temp_directory)
+from src.jobs import JobQueue, format_error
+from src.scheduler import HTML, PDF, Saturated, default_limits
+from src.artifacts import (ArtifactStore, DEFAULT_QUOTA, DEFAULT_SCRATCH_AGE,
+                           DEFAULT_TTL)
+from src.compression import choose_variant
+from src.lexicon import (DEFAULT_SEARCH_LIMIT, LEXICON_STORE_SIZE,
+                         MAX_SEARCH_LIMIT, LexiconStore)
+from src.startup import Startup
+from src import metrics
+from src.uploads import spool_uploads
 
 base_directory = os.path.dirname(os.path.abspath(__file__))
 
@@ -17,13 +27,69 @@ os.environ.setdefault('PYPANDOC_PANDOC',
 
 app = Flask(__name__)
 
+# Let a front-end server such as nginx send files when it is configured to.
+app.config['USE_X_SENDFILE'] = os.environ.get('CODA_X_SENDFILE') == '1'
+
+# Report the time spent in each stage of a render in a Server-Timing header
+# on the status of a finished job.
+server_timing = os.environ.get('CODA_SERVER_TIMING') == '1'
+
+# Finished artifacts are removed after their time to live, or when the
+# temp directory is over its quota. Scratch directories left by crashed
+# renders are removed once they are older than any render can take.
+artifacts = ArtifactStore(
+    temp_directory,
+    ttl=int(os.environ.get('CODA_ARTIFACT_TTL', DEFAULT_TTL)),
+    quota=int(os.environ.get('CODA_ARTIFACT_QUOTA', DEFAULT_QUOTA)),
+    scratch_directory=scratch_directory,
+    scratch_age=int(os.environ.get('CODA_SCRATCH_AGE', DEFAULT_SCRATCH_AGE)))
+
+# Renders run in a pool of worker processes, one per core by default. Only
+# so many PDF and HTML builds run or wait at once; requests beyond that are
+# refused until there is room.
+workers = int(os.environ.get('CODA_WORKERS', os.cpu_count()))
+job_limits = default_limits(workers)
+job_limits[PDF] = (int(os.environ.get('CODA_MAX_PDF_JOBS',
+                                      job_limits[PDF][0])),
+                   int(os.environ.get('CODA_PDF_QUEUE_DEPTH',
+                                      job_limits[PDF][1])))
+job_limits[HTML] = (int(os.environ.get('CODA_MAX_HTML_JOBS',
+                                       job_limits[HTML][0])),
+                    int(os.environ.get('CODA_HTML_QUEUE_DEPTH',
+                                       job_limits[HTML][1])))
+
+jobs = JobQueue(
+    render_cache,
+    temp_directory,
+    max_workers=workers,
+    artifacts=artifacts,
+    limits=job_limits)
+
+# Uploaded lexicons, indexed for live lookups by the front-end.
+lexicons = LexiconStore(
+    size=int(os.environ.get('CODA_LEXICON_STORE_SIZE', LEXICON_STORE_SIZE)))
+
+# Warms up pandoc, the themes and xelatex before the server reports ready.
+startup = Startup()
+
 available_settings = [
     'grammarTitle', 'grammarSubtitle', 'author', 'format', 'theme',
     'csvColumnWord', 'csvColumnLocal', 'csvColumnDefinition',
-    'csvColumnPronunciation', 'csvColumnPartOfSpeech', 'layout'
+    'csvColumnPronunciation', 'csvColumnPartOfSpeech', 'layout',
+    'lexiconDefinitions', 'project'
 ]
 
 
+@app.before_request
+def start_background_work():
+    '''Start removing expired artifacts, find pandoc and start its servers,
+    then warm up in the background. The first request in each process starts
+    them, so they run under a WSGI server as well, and not in the debug
+    reloader's watching process. /ready reports when warm-up is done.'''
+    artifacts.start()
+    startup.start()
+
+
 @app.route('/', methods=['POST'])
 def index():
     # Get all available string settings from posted object
@@ -32,31 +98,142 @@ def index():
         settings[key] = request.form.get(key, None)
 
     try:
-        # Loop through the files posted to the endpoint, reading all
-        # files as strings.
-        markdown_file_strings = []
-        lexicon_file_string = None
-        for filename, blob in request.files.items():
-            if filename.endswith('.csv'):
-                lexicon_file_string = str(blob.read(), 'utf-8')
-            else:
-                markdown_file_strings.append(str(blob.read(), 'utf-8'))
-
-        filename = generate(markdown_file_strings, lexicon_file_string,
-                            settings)
-
-        print("In index function, returning file: " + filename)
-        return filename
+        # Save the files posted to the endpoint to disk, unpacking any
+        # archives. They are read from there as streams by the render.
+        uploads = spool_uploads(request.files.items(), scratch_directory)
+
+        job_id = jobs.submit(
+            uploads.chapters,
+            uploads.lexicon,
+            settings,
+            upload_directory=uploads.directory)
+
+        print("In index function, returning job: " + job_id)
+        return job_id
+    except Saturated as e:
+        return format_error(e), 503, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        return format_error(e)
+
+
+@app.route('/lexicons', methods=['POST'])
+def upload_lexicon():
+    '''Parse and index an uploaded CSV lexicon, with the same column settings
+    as a render, and return its id for queries.'''
+    settings = {}
+    for key in available_settings:
+        settings[key] = request.form.get(key, None)
+
+    try:
+        uploads = spool_uploads(request.files.items(), scratch_directory)
+
+        try:
+            if uploads.lexicon is None:
+                return 'No lexicon uploaded', 400
+
+            lexicon_id = lexicons.add(uploads.lexicon,
+                                      read_lexicon_columns(settings))
+        finally:
+            uploads.remove()
+
+        return jsonify({
+            'id': lexicon_id,
+            'entries': len(lexicons.get(lexicon_id))
+        })
     except Exception as e:
-        return 'ERROR' + str(type(e).__name__) + ': ' + str(e)
+        return format_error(e)
+
+
+@app.route('/lexicons/<lexicon_id>/search')
+def search_lexicon(lexicon_id):
+    '''Return the entries whose word, or local word if field is local, starts
+    with prefix, in alphabetical order.'''
+    lexicon = lexicons.get(lexicon_id)
+    if lexicon is None:
+        return 'Lexicon not found', 404
+
+    field = request.args.get('field', 'word')
+    if field not in ['word', 'local']:
+        return 'Unknown field: ' + field, 400
+
+    limit = min(
+        request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int),
+        MAX_SEARCH_LIMIT)
+
+    entries = lexicon.search(request.args.get('prefix', ''), field, limit)
+
+    return jsonify([entry.as_dict() for entry in entries])
+
+
+@app.route('/lexicons/<lexicon_id>/lookup')
+def lookup_lexicon(lexicon_id):
+    '''Return the entries with exactly the given word or local word.'''
+    lexicon = lexicons.get(lexicon_id)
+    if lexicon is None:
+        return 'Lexicon not found', 404
+
+    if 'word' in request.args:
+        entry = lexicon.get(request.args['word'])
+        entries = [] if entry is None else [entry]
+    elif 'local' in request.args:
+        entries = lexicon.get_local(request.args['local'])
+    else:
+        return 'Either word or local is required', 400
+
+    return jsonify([entry.as_dict() for entry in entries])
+
+
+@app.route('/status')
+def status():
+    '''Report the state of a render job: queued, running, done or failed.'''
+    job = jobs.get(request.args.get('job'))
+
+    if job is None:
+        return 'Job not found', 404
+
+    response = jsonify(job.as_dict())
+
+    if server_timing and job.spans:
+        response.headers['Server-Timing'] = metrics.server_timing(job.spans)
+
+    return response
+
+
+@app.route('/ready')
+def ready():
+    '''Report whether warm-up has finished, so that a load balancer only
+    sends requests once they will be served at their usual speed.'''
+    return jsonify(startup.as_dict()), 200 if startup.ready else 503
+
+
+@app.route('/queue')
+def queue_stats():
+    '''Report the running and queued builds of each kind, and how many
+    requests have been refused.'''
+    return jsonify(jobs.scheduler.stats())
+
+
+@app.route('/metrics')
+def metrics_exposition():
+    '''Report histograms of the time spent in each stage of a render, in the
+    Prometheus text format.'''
+    return app.response_class(
+        metrics.registry.exposition(),
+        mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/download')
 def download():
-    filename = request.args.get('filename')
+    # Files can be requested by job id or directly by filename.
+    job_id = request.args.get('job')
+    if job_id is not None:
+        job = jobs.get(job_id)
+        if job is None or job.filename is None:
+            return 'File not found', 404
 
-    filepath = os.path.join(base_directory, 'temp', filename)
-    print("Downloading filepath: " + filepath)
+        filename = job.filename
+    else:
+        filename = request.args.get('filename', '')
 
     if filename.endswith('.html'):
         mimetype = 'text/html; charset=utf-8'
@@ -64,40 +241,51 @@ def download():
     elif filename.endswith('.pdf'):
         mimetype = 'application/pdf'
         attachment_filename = 'Grammar.pdf'
+    elif filename.endswith('.zip'):
+        mimetype = 'application/zip'
+        attachment_filename = 'Grammar.zip'
     else:
         return 'File not found', 404
 
-    # Read the file into a BytesIO object, allowing it to be deleted before the
-    # request is fulfilled.
-    with open(filepath, 'rb') as f:
-        file_object = io.BytesIO(f.read())
+    # Keep the file from being removed while it is being downloaded.
+    filepath = artifacts.acquire(filename)
+    if filepath is None:
+        return 'File not found', 404
 
-    os.remove(filepath)
+    print("Downloading filepath: " + filepath)
 
-    return send_file(
-        file_object,
-        mimetype=mimetype,
-        as_attachment=True,
-        attachment_filename=attachment_filename)
+    try:
+        # Serve a precompressed variant if the client accepts one.
+        variant_path, encoding = choose_variant(filepath,
+                                                request.accept_encodings)
 
+        # Stream the file from disk. Conditional responses support range
+        # requests, so large downloads can be resumed.
+        response = send_file(
+            variant_path,
+            mimetype=mimetype,
+            as_attachment=True,
+            attachment_filename=attachment_filename,
+            conditional=True)
+    except Exception:
+        artifacts.release(filename, downloaded=False)
+        raise
 
-def check_pandoc_on_startup():
-    '''On startup, checks if pandoc is installed. If it is, continues to main
-    application. Otherwise, pandoc will be installed.'''
-    print('Looking for pandoc...')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
 
-    try:
-        version = pypandoc.get_pandoc_version()
-        print('Found version {0}'.format(version))
+    # The file expires a while after the response has been sent.
+    response.call_on_close(lambda: artifacts.release(filename))
 
-    except OSError:
-        print('Not found! Downloading...')
+    return response
 
-        pypandoc.pandoc_download.download_pandoc()
 
-        print('Download complete!')
+@app.route('/artifacts')
+def artifact_stats():
+    '''Report disk usage and eviction statistics for finished artifacts.'''
+    return jsonify(artifacts.stats())
 
 
 if __name__ == '__main__':
-    check_pandoc_on_startup()
     app.run(debug=True, host='0.0.0.0')
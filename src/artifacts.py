@@ -0,0 +1,230 @@
+import os
+import shutil
+import threading
+import time
+
+from src.compression import variants
+
+# File extensions of finished artifacts.
+ARTIFACT_EXTENSIONS = ['.pdf', '.html', '.zip']
+
+DEFAULT_TTL = 60 * 60
+DEFAULT_QUOTA = 2 * 1024 * 1024 * 1024
+
+# Seconds to keep an artifact after its download finishes, so that an
+# interrupted download can be resumed with a range request.
+DOWNLOAD_GRACE_PERIOD = 10 * 60
+
+REAP_INTERVAL = 60
+
+# Seconds before an abandoned scratch directory is removed. This must be
+# longer than any render can take, including its time in the queue, since a
+# directory's modification time does not change while a build rewrites the
+# files in it.
+DEFAULT_SCRATCH_AGE = 6 * 60 * 60
+
+
+class Artifact:
+    '''A finished artifact and its compressed variants.'''
+
+    def __init__(self, path, created):
+        self.path = path
+        self.created = created
+        self.last_used = created
+        self.expires = None
+        self.users = 0
+        self.size = sum(os.path.getsize(x) for x in variants(path))
+
+
+class ArtifactStore:
+    '''Tracks the artifacts in a directory. Each artifact expires after a time
+    to live, or shortly after it is downloaded, and the least recently used
+    artifacts are evicted when the directory is over its quota. Artifacts
+    which are being downloaded are never removed.
+
+    Directories in the scratch directory are removed once they are older than
+    scratch_age, unless they have been acquired with acquire_scratch.'''
+
+    def __init__(self,
+                 directory,
+                 ttl=DEFAULT_TTL,
+                 quota=DEFAULT_QUOTA,
+                 scratch_directory=None,
+                 scratch_age=DEFAULT_SCRATCH_AGE,
+                 reap_interval=REAP_INTERVAL):
+        self.directory = directory
+        self.ttl = ttl
+        self.quota = quota
+        self.scratch_directory = scratch_directory
+        self.scratch_age = scratch_age
+        self.reap_interval = reap_interval
+
+        self._lock = threading.Lock()
+        self._artifacts = {}
+        self._scratch_in_use = set()
+        self._reaper = None
+
+        self.expirations = 0
+        self.evictions = 0
+
+    def add(self, filename):
+        '''Start tracking a new artifact in the directory.'''
+        path = os.path.join(self.directory, filename)
+
+        with self._lock:
+            if filename not in self._artifacts and os.path.exists(path):
+                self._track(filename, time.time())
+
+        self._enforce_quota()
+
+    def acquire(self, filename):
+        '''Mark an artifact as in use and return its path, or None if there is
+        no such artifact. Every acquire must be followed by a release.'''
+        filename = os.path.basename(filename)
+        path = os.path.join(self.directory, filename)
+
+        with self._lock:
+            artifact = self._artifacts.get(filename)
+            if artifact is None:
+                if not os.path.exists(path):
+                    return None
+                artifact = self._track(filename, os.path.getmtime(path))
+
+            artifact.users += 1
+            artifact.last_used = time.time()
+
+            return artifact.path
+
+    def release(self, filename, downloaded=True):
+        '''Mark an artifact as no longer in use. A downloaded artifact expires
+        after the download grace period.'''
+        filename = os.path.basename(filename)
+
+        with self._lock:
+            artifact = self._artifacts.get(filename)
+            if artifact is None:
+                return
+
+            artifact.users -= 1
+            artifact.last_used = time.time()
+
+            if downloaded:
+                artifact.expires = min(artifact.expires,
+                                       time.time() + DOWNLOAD_GRACE_PERIOD)
+
+    def acquire_scratch(self, path):
+        '''Keep a scratch directory, such as the uploads of a queued job, from
+        being removed until it is released.'''
+        with self._lock:
+            self._scratch_in_use.add(os.path.basename(path))
+
+    def release_scratch(self, path):
+        with self._lock:
+            self._scratch_in_use.discard(os.path.basename(path))
+
+    def reap(self):
+        '''Adopt untracked artifacts, remove expired artifacts and enforce the
+        quota. Stale scratch directories are also removed.'''
+        now = time.time()
+
+        with self._lock:
+            for filename in os.listdir(self.directory):
+                if (filename not in self._artifacts
+                        and os.path.splitext(filename)[1] in
+                        ARTIFACT_EXTENSIONS):
+                    path = os.path.join(self.directory, filename)
+                    try:
+                        self._track(filename, os.path.getmtime(path))
+                    except FileNotFoundError:
+                        pass
+
+            for filename, artifact in list(self._artifacts.items()):
+                if artifact.users == 0 and artifact.expires <= now:
+                    self._remove(filename)
+                    self.expirations += 1
+
+        self._enforce_quota()
+
+        if self.scratch_directory is not None:
+            self._reap_scratch(now)
+
+    def start(self):
+        '''Start reaping in a background thread, unless it has already been
+        started.'''
+        with self._lock:
+            if self._reaper is not None:
+                return
+
+            self._reaper = threading.Thread(target=self._reap_forever)
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def stats(self):
+        '''Return a dictionary of statistics about the store.'''
+        with self._lock:
+            return {
+                'artifacts': len(self._artifacts),
+                'in_use': sum(1 for x in self._artifacts.values() if x.users),
+                'bytes_used': sum(x.size for x in self._artifacts.values()),
+                'quota': self.quota,
+                'ttl': self.ttl,
+                'expirations': self.expirations,
+                'evictions': self.evictions
+            }
+
+    def _track(self, filename, created):
+        artifact = Artifact(os.path.join(self.directory, filename), created)
+        artifact.expires = created + self.ttl
+        self._artifacts[filename] = artifact
+
+        return artifact
+
+    def _enforce_quota(self):
+        with self._lock:
+            used = sum(x.size for x in self._artifacts.values())
+            if used <= self.quota:
+                return
+
+            # Evict the least recently used artifacts which are not in use.
+            candidates = sorted(
+                (artifact.last_used, filename)
+                for filename, artifact in self._artifacts.items()
+                if artifact.users == 0)
+
+            for _, filename in candidates:
+                if used <= self.quota:
+                    break
+
+                used -= self._artifacts[filename].size
+                self._remove(filename)
+                self.evictions += 1
+
+    def _remove(self, filename):
+        artifact = self._artifacts.pop(filename)
+
+        for path in variants(artifact.path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _reap_scratch(self, now):
+        for name in os.listdir(self.scratch_directory):
+            with self._lock:
+                if name in self._scratch_in_use:
+                    continue
+
+            path = os.path.join(self.scratch_directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.scratch_age:
+                    shutil.rmtree(path, ignore_errors=True)
+            except FileNotFoundError:
+                pass
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                print('Error reaping artifacts: ' + str(e))
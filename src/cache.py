@@ -0,0 +1,315 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from src.artifacts import ARTIFACT_EXTENSIONS
+from src.compression import original_path, variants
+
+# Settings which change the rendered output. Anything else posted to the
+# server is ignored when building a cache key.
+RENDER_SETTINGS = [
+    'grammarTitle', 'grammarSubtitle', 'author', 'format', 'theme',
+    'csvColumnWord', 'csvColumnLocal', 'csvColumnDefinition',
+    'csvColumnPronunciation', 'csvColumnPartOfSpeech', 'layout',
+    'lexiconDefinitions'
+]
+
+# Directories whose contents are baked into every render. Changing a theme,
+# template or filter invalidates all cached artifacts.
+VERSIONED_DIRECTORIES = ['themes', 'filters']
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+# Seconds between full scans of the cache directory, which remove expired
+# entries and correct the running size for writes by other processes.
+SCAN_INTERVAL = 60
+
+# Eviction removes entries until the cache is this fraction of max_bytes, so
+# that the next few writes do not each need another scan.
+EVICTION_TARGET = 0.9
+
+
+def hash_directories(base_directory, directories):
+    '''Return a digest of the contents of every file in the given directories,
+    which are relative to base_directory.'''
+    digest = hashlib.sha256()
+
+    for directory in directories:
+        for root, dirs, files in os.walk(os.path.join(base_directory,
+                                                      directory)):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.endswith('.pyc'):
+                    continue
+
+                path = os.path.join(root, filename)
+                digest.update(os.path.relpath(path, base_directory).encode())
+                update_from_file(digest, path)
+
+    return digest.hexdigest()
+
+
+def update_from_file(digest, path):
+    '''Add the contents of a file to a digest, without reading the whole file
+    into memory.'''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+
+
+def update_from_source(digest, source):
+    '''Add a source to a digest. A source is either a string or an uploaded
+    file on disk with a path attribute, and both give the same digest for the
+    same content.'''
+    if isinstance(source, str):
+        digest.update(source.encode('utf-8'))
+    else:
+        update_from_file(digest, source.path)
+
+
+class RenderCache:
+    '''A persistent, content-addressed store of finished artifacts. Each entry
+    is a file named after its key, with one of the cache's extensions, and
+    its compressed variants.
+
+    Lookups only check the entry's own paths. The size of the cache is kept as
+    a running total, and the directory is only scanned when the total is over
+    max_bytes or every SCAN_INTERVAL seconds.'''
+
+    def __init__(self,
+                 directory,
+                 base_directory,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 max_age=DEFAULT_MAX_AGE,
+                 extensions=ARTIFACT_EXTENSIONS):
+        self.directory = directory
+        self.base_directory = base_directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.extensions = extensions
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._version = None
+        self._version_checked = 0
+        self._size = None
+        self._scanned = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def version(self):
+        '''Return a digest of the theme, template and filter files. The digest
+        is recomputed at most once a second.'''
+        now = time.time()
+        if self._version is None or now - self._version_checked > 1:
+            self._version = hash_directories(self.base_directory,
+                                             VERSIONED_DIRECTORIES)
+            self._version_checked = now
+
+        return self._version
+
+    def key(self, markdown_file_strings, lexicon_file, settings):
+        '''Return the cache key for a render request.'''
+        digest = hashlib.sha256()
+
+        # The date is stamped into every document, so an artifact is only
+        # reusable on the day it was made.
+        normalized_settings = {
+            key: settings.get(key)
+            for key in RENDER_SETTINGS
+        }
+        normalized_settings['date'] = time.strftime('%Y-%m-%d')
+
+        digest.update(self.version().encode())
+        digest.update(json.dumps(normalized_settings, sort_keys=True).encode())
+
+        for markdown in markdown_file_strings:
+            digest.update(b'\0markdown\0')
+            update_from_source(digest, markdown)
+
+        digest.update(b'\0lexicon\0')
+        update_from_source(digest, lexicon_file or '')
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        '''Return the path of the cached artifact for the key, or None if
+        there is no fresh entry.'''
+        for extension in self.extensions:
+            path = os.path.join(self.directory, key + extension)
+            try:
+                if time.time() - os.path.getmtime(path) > self.max_age:
+                    self._remove(path)
+                    return None
+
+                # Touch the entry so that eviction is least-recently-used.
+                for variant_path in variants(path):
+                    os.utime(variant_path)
+            except FileNotFoundError:
+                continue
+
+            return path
+
+        return None
+
+    def put(self, key, path):
+        '''Copy the artifact at path, and its compressed variants, into the
+        cache under the given key, then evict old entries if necessary.
+        Returns the cached path.'''
+        extension = os.path.splitext(path)[1]
+        cached_path = os.path.join(self.directory, key + extension)
+
+        # Copy the variants first, and each to a hidden temporary name, so
+        # that readers never see a partial file.
+        size = 0
+        for variant_path in reversed(variants(path)):
+            suffix = variant_path[len(path):]
+            partial_path = self._partial_path(key)
+            shutil.copyfile(variant_path, partial_path)
+            size += os.path.getsize(partial_path)
+            os.replace(partial_path, cached_path + suffix)
+
+        self._added(size)
+
+        return cached_path
+
+    def store(self, key, data, extension):
+        '''Store bytes in the cache under the given key and extension, then
+        evict old entries if necessary. Returns the cached path.'''
+        cached_path = os.path.join(self.directory, key + extension)
+
+        partial_path = self._partial_path(key)
+        with open(partial_path, 'wb') as f:
+            f.write(data)
+        os.replace(partial_path, cached_path)
+
+        self._added(len(data))
+
+        return cached_path
+
+    def checkout(self, cached_path, output_directory, filename=None):
+        '''Place a copy of a cached artifact in the output directory and return
+        its filename. Downloads delete their file, so the cache never hands
+        out its own copy.'''
+        if filename is None:
+            extension = os.path.splitext(cached_path)[1]
+            filename = uuid.uuid4().hex + extension
+
+        output_path = os.path.join(output_directory, filename)
+
+        for variant_path in variants(cached_path):
+            suffix = variant_path[len(cached_path):]
+            try:
+                os.link(variant_path, output_path + suffix)
+            except OSError:
+                shutil.copyfile(variant_path, output_path + suffix)
+
+        return filename
+
+    def evict(self):
+        '''Remove entries older than max_age, then, if the cache is larger
+        than max_bytes, remove the least recently used entries until it fits
+        in EVICTION_TARGET of max_bytes. An entry's variants are counted and
+        removed with it, and files still being written are left alone.'''
+        entries = {}
+        now = time.time()
+
+        for filename in os.listdir(self.directory):
+            # Partial files are hidden.
+            if filename.startswith('.'):
+                continue
+
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                continue
+
+            path = os.path.join(self.directory, original_path(filename))
+            mtime, size = entries.get(path, (0, 0))
+            entries[path] = (max(mtime, stat.st_mtime), size + stat.st_size)
+
+        for path, (mtime, _) in list(entries.items()):
+            if now - mtime > self.max_age:
+                self._remove(path)
+                del entries[path]
+
+        total = sum(size for _, size in entries.values())
+        if total > self.max_bytes:
+            for path, (_, size) in sorted(entries.items(),
+                                          key=lambda x: x[1][0]):
+                if total <= self.max_bytes * EVICTION_TARGET:
+                    break
+
+                self._remove(path)
+                total -= size
+
+        with self._lock:
+            self._size = total
+            self._scanned = now
+
+    def fetch(self, key, render, output_directory):
+        '''Return the filename of an artifact in output_directory for the key.
+        On a miss, render() is called to produce a file in output_directory
+        and the result is cached. Concurrent fetches of the same key share a
+        single call to render().'''
+        cached_path = self.get(key)
+        if cached_path is not None:
+            return self.checkout(cached_path, output_directory)
+
+        with self._lock:
+            event = self._in_flight.get(key)
+            owner = event is None
+            if owner:
+                event = self._in_flight[key] = threading.Event()
+
+        if not owner:
+            # Another thread is rendering the same document; wait for it and
+            # take a copy of its result.
+            event.wait()
+            cached_path = self.get(key)
+            if cached_path is None:
+                raise Exception('Error in shared render: the render of an '
+                                'identical request failed')
+
+            return self.checkout(cached_path, output_directory)
+
+        try:
+            filename = render()
+            self.put(key, os.path.join(output_directory, filename))
+            return filename
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            event.set()
+
+    def _added(self, size):
+        # Scan the directory on the first write, when the running total is
+        # over max_bytes, or when the last scan is out of date.
+        with self._lock:
+            scan = (self._size is None
+                    or time.time() - self._scanned > SCAN_INTERVAL)
+            if not scan:
+                self._size += size
+                scan = self._size > self.max_bytes
+
+        if scan:
+            self.evict()
+
+    def _partial_path(self, key):
+        # Hidden, and unique to the writer, so concurrent writers of the same
+        # key never share a file.
+        return os.path.join(self.directory, '.{0}.{1}.partial'.format(
+            key, uuid.uuid4().hex))
+
+    def _remove(self, path):
+        '''Remove an entry and its compressed variants.'''
+        for variant_path in variants(path):
+            try:
+                os.remove(variant_path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,189 @@
+import copy
+import hashlib
+import json
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from src import metrics, pandoc
+from src.cache import update_from_file
+
+# Matches a labelled example or a reference to one, e.g. (@good). Pandoc
+# resolves these to numbers while reading, so they only survive being read
+# chapter by chapter if every chapter is read together.
+LABELLED_EXAMPLE = re.compile(r'\(@[\w-]+\)')
+
+
+class MarkdownFile:
+    '''A markdown source stored on disk, which is read by pandoc directly
+    rather than being loaded into memory. The name is the one it was uploaded
+    under, if any, which identifies it across builds of the same project.'''
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name
+
+    def digest(self):
+        digest = hashlib.sha256()
+        update_from_file(digest, self.path)
+
+        return digest.hexdigest()
+
+    def open(self):
+        return open(self.path, encoding='utf-8')
+
+
+def chapter_key(chapter, reader_arguments):
+    '''Return the cache key of a chapter's AST.'''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(reader_arguments).encode())
+
+    if isinstance(chapter, MarkdownFile):
+        digest.update(chapter.digest().encode())
+    else:
+        digest.update(hashlib.sha256(chapter.encode('utf-8')).digest())
+
+    return digest.hexdigest()
+
+
+def read_chapter(chapter, reader_arguments, cache):
+    '''Read a chapter (a markdown string or a MarkdownFile) into a pandoc JSON
+    AST, which is cached by the chapter's content. A chapter which has already
+    been read, as a JSON AST dictionary, is copied.'''
+    if isinstance(chapter, dict):
+        return copy.deepcopy(chapter)
+
+    key = chapter_key(chapter, reader_arguments)
+
+    cached_path = cache.get(key)
+    if cached_path is not None:
+        with open(cached_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    with metrics.span('pandoc_read') as span:
+        if isinstance(chapter, MarkdownFile):
+            ast = pandoc.convert_file(
+                chapter.path,
+                format='md',
+                to='json',
+                extra_args=reader_arguments)
+        else:
+            ast = pandoc.convert_text(
+                chapter, format='md', to='json', extra_args=reader_arguments)
+
+        span['bytes'] = len(ast)
+
+    cache.store(key, ast.encode('utf-8'), '.json')
+
+    return json.loads(ast)
+
+
+def read_chapters(chapters, reader_arguments, cache, max_workers=None):
+    '''Read each chapter into a pandoc JSON AST in parallel and merge them
+    into a single document. Each chapter runs in its own pandoc process, so
+    a thread pool is enough to use every core.'''
+    spans = metrics.current()
+
+    def read(chapter):
+        with metrics.using(spans):
+            return read_chapter(chapter, reader_arguments, cache)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        documents = list(executor.map(read, chapters))
+
+    return merge_documents(documents)
+
+
+def has_labelled_examples(chapters):
+    '''Return True if any chapter uses labelled examples. Files are scanned a
+    line at a time.'''
+    for chapter in chapters:
+        if isinstance(chapter, MarkdownFile):
+            with chapter.open() as f:
+                if any(LABELLED_EXAMPLE.search(line) for line in f):
+                    return True
+
+        elif isinstance(chapter, str) and LABELLED_EXAMPLE.search(chapter):
+            return True
+
+    return False
+
+
+def concatenate_chapters(chapters, path):
+    '''Write every chapter to a single markdown file, separated by blank
+    lines, and return it as a MarkdownFile. Files are copied in chunks.'''
+    with open(path, 'w', encoding='utf-8') as f:
+        for number, chapter in enumerate(chapters):
+            if number > 0:
+                f.write('\n\n')
+
+            if isinstance(chapter, MarkdownFile):
+                with chapter.open() as source:
+                    shutil.copyfileobj(source, f)
+            else:
+                f.write(chapter)
+
+    return MarkdownFile(path)
+
+
+def merge_documents(documents):
+    '''Concatenate pandoc JSON documents into one. Metadata from later
+    documents overrides earlier documents, and example lists are numbered
+    continuously across the whole document.'''
+    merged = {
+        'pandoc-api-version': documents[0]['pandoc-api-version'],
+        'meta': {},
+        'blocks': []
+    }
+
+    for document in documents:
+        merged['meta'].update(document['meta'])
+        merged['blocks'].extend(document['blocks'])
+
+    renumber_examples(merged['blocks'], 1)
+    deduplicate_identifiers(merged['blocks'], set())
+
+    return merged
+
+
+def renumber_examples(node, number):
+    '''Number every example list under the node in document order, starting
+    from the given number, and return the next unused number.'''
+    if isinstance(node, list):
+        for child in node:
+            number = renumber_examples(child, number)
+
+    elif isinstance(node, dict):
+        if node.get('t') == 'OrderedList':
+            attributes, items = node['c']
+            if attributes[1].get('t') == 'Example':
+                attributes[0] = number
+                number += len(items)
+
+        number = renumber_examples(node.get('c'), number)
+
+    return number
+
+
+def deduplicate_identifiers(node, seen):
+    '''Give every header under the node a unique identifier, adding a numeric
+    suffix to repeats in the same way as pandoc.'''
+    if isinstance(node, list):
+        for child in node:
+            deduplicate_identifiers(child, seen)
+
+    elif isinstance(node, dict):
+        if node.get('t') == 'Header':
+            attributes = node['c'][1]
+            identifier = attributes[0]
+
+            if identifier in seen:
+                suffix = 1
+                while '{0}-{1}'.format(identifier, suffix) in seen:
+                    suffix += 1
+                identifier = '{0}-{1}'.format(identifier, suffix)
+                attributes[0] = identifier
+
+            seen.add(identifier)
+
+        deduplicate_identifiers(node.get('c'), seen)
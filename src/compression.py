@@ -0,0 +1,60 @@
+import gzip
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content encodings of precompressed variants, in order of preference, with
+# the suffix added to the artifact's filename.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+VARIANT_SUFFIXES = [suffix for _, suffix in ENCODINGS]
+
+
+def compress_artifact(path):
+    '''Write gzip and, if the brotli module is installed, brotli compressed
+    copies of the file next to it.'''
+    with open(path, 'rb') as source:
+        with gzip.open(path + '.gz', 'wb', compresslevel=9) as f:
+            shutil.copyfileobj(source, f)
+
+    if brotli is not None:
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT)
+
+        with open(path, 'rb') as source, open(path + '.br', 'wb') as f:
+            for chunk in iter(lambda: source.read(65536), b''):
+                f.write(compressor.process(chunk))
+            f.write(compressor.finish())
+
+
+def variants(path):
+    '''Return the paths of the file and all of its compressed variants that
+    exist.'''
+    return [path] + [
+        path + suffix for suffix in VARIANT_SUFFIXES
+        if os.path.exists(path + suffix)
+    ]
+
+
+def original_path(path):
+    '''Return the path of the file a compressed variant was made from, or the
+    path itself if it is not a variant.'''
+    for suffix in VARIANT_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+
+    return path
+
+
+def choose_variant(path, accept_encodings):
+    '''Return the path and content encoding of the best variant of the file
+    for the client's Accept-Encoding header. The encoding is None for the
+    uncompressed file.'''
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] and os.path.exists(path + suffix):
+            return path + suffix, encoding
+
+    return path, None
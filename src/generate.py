@@ -1,30 +1,86 @@
 import time
-import pypandoc
+import hashlib
+import shutil
+import tempfile
+import uuid
+import zipfile
+import panflute as pf
+import io
 import os
 import re
-import csv
+import json
 import string
-from subprocess import call
-from itertools import groupby
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
-JUNK_FILE_SUFFIXES = [
-    'tex', 'aux', 'bcf', 'idx', 'log', 'ptc', 'run.xml', 'toc'
-]
-
-LEXICON_COLUMN_DEFAULTS = {
-    'word': 0,
-    'local': 1,
-    'part_of_speech': 3,
-    'definition': 5,
-    'pronunciation': 2
-}
+from filters import HTML as html_filter
+from filters import LaTeX as latex_filter
+from filters.core import Timings
+from src.cache import RenderCache, DEFAULT_MAX_AGE, DEFAULT_MAX_BYTES
+from src import metrics, pandoc
+from src.compression import compress_artifact, variants
+from src.chapters import (MarkdownFile, concatenate_chapters,
+                          has_labelled_examples, read_chapters)
+from src.latex import compile_pdf
+from src.lexicon import LEXICON_COLUMN_DEFAULTS, load_lexicon
+from src.themes import ThemeRegistry
 
 base_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+temp_directory = os.path.join(base_directory, 'temp')
+
+# Each render works in its own scratch directory inside this one.
+scratch_directory = os.path.join(temp_directory, 'jobs')
+
+os.makedirs(scratch_directory, exist_ok=True)
+
+render_cache = RenderCache(
+    os.path.join(base_directory, 'cache', 'renders'),
+    base_directory,
+    max_bytes=int(os.environ.get('CODA_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+    max_age=int(os.environ.get('CODA_CACHE_MAX_AGE', DEFAULT_MAX_AGE)))
+
+# Pandoc ASTs of individual chapters, keyed by their content.
+chapter_cache = RenderCache(
+    os.path.join(base_directory, 'cache', 'chapters'),
+    base_directory,
+    max_bytes=int(os.environ.get('CODA_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+    max_age=int(os.environ.get('CODA_CACHE_MAX_AGE', DEFAULT_MAX_AGE)),
+    extensions=['.json'])
+
+# Number of chapters read by pandoc at once.
+chapter_workers = int(os.environ.get('CODA_CHAPTER_WORKERS', os.cpu_count()))
+
+# Cross-reference state kept between LaTeX builds of the same project.
+latex_state_directory = os.path.join(base_directory, 'cache', 'latex')
+
+# Precompiled preambles of the LaTeX templates.
+latex_format_directory = os.path.join(base_directory, 'cache', 'formats')
+
+# Minified header bundles of the HTML themes, rebuilt when a theme changes.
+theme_registry = ThemeRegistry(
+    os.path.join(base_directory, 'themes', 'html'),
+    os.path.join(base_directory, 'cache', 'themes'))
+
+latex_template_directory = os.path.join(base_directory, 'themes', 'latex')
+
+# Paper, margins and font size of each PDF layout.
+LATEX_LAYOUTS = {
+    'A4': {
+        'papersize': 'a4paper',
+        'geometry': 'top=3cm,bottom=3cm,left=3cm,right=3cm,headsep=10pt,',
+        'fontsize': '11pt'
+    },
+    'A5': {
+        'papersize': 'a5paper',
+        'geometry':
+        'top=1.5cm,bottom=1.5cm,left=1.75cm,right=1.75cm,headsep=10pt,',
+        'fontsize': '12pt'
+    }
+}
 
-with open(os.path.join(base_directory, 'themes', 'latex',
-                       'Dictionary.tex')) as f:
-    DICTIONARY_TEMPLATE = f.read()
+# The LaTeX dictionary template, read on first use.
+_dictionary_template = None
 
 DEFINITION_TEMPLATE = '''
 <span class="word">$word
@@ -34,6 +90,20 @@ DEFINITION_TEMPLATE = '''
 </span>
 '''
 
+DEFINITION_BLOCK = string.Template(DEFINITION_TEMPLATE)
+
+# In the lookup table mode, each reference is replaced with a bare word,
+# whose definition is added from the table by the script in after.html when
+# the word is first hovered over.
+WORD_REFERENCE_TEMPLATE = '<span class="word">{0}</span>'
+
+LEXICON_TABLE_TEMPLATE = '''
+<script type="application/json" id="lexicon-definitions">{0}</script>
+'''
+
+# Matches a lexicon reference left in the HTML by the filter.
+LEXICON_REFERENCE = re.compile(r'{{([a-z]*)}}', re.I)
+
 DICTIONARY_ENTRY_TEMPLATE = '''
 \entry{$word}{$pronunciation}{$part_of_speech}{$local_word: $definition}
 '''
@@ -51,6 +121,13 @@ HTML_DICTIONARY_ENTRY_TEMPLATE = '''
 </div>
 '''
 
+# Pandoc options which apply when reading markdown, rather than when writing
+# the output format.
+READER_ARGUMENTS = ['--smart']
+
+# Dictionary output is produced in chunks of roughly this many characters.
+DICTIONARY_CHUNK_SIZE = 64 * 1024
+
 METADATA_TEMPLATE = '''
 ---
 title: $title
@@ -66,30 +143,152 @@ dictionary: $dictionary
 
 
 def generate(markdown_file_strings, lexicon_file, settings):
-    concatenated_markdown = '\n\n'.join(markdown_file_strings)
+    '''Render the request, reusing a cached artifact if an identical request
+    has been rendered before. Returns the filename of the artifact in the temp
+    directory.'''
+    key = render_cache.key(markdown_file_strings, lexicon_file, settings)
+
+    return render_cache.fetch(
+        key, lambda: render(markdown_file_strings, lexicon_file, settings),
+        temp_directory)
+
 
+def render_with_spans(markdown_file_strings, lexicon_file, settings):
+    '''Render the request without consulting the cache. Returns the filename
+    of the artifact and a list of timing spans for each stage.'''
+    with metrics.recording() as spans:
+        filename = render(markdown_file_strings, lexicon_file, settings)
+
+    return filename, spans
+
+
+def render(markdown_file_strings, lexicon_file, settings):
+    '''Render the request without consulting the cache.'''
     lexicon_columns = read_lexicon_columns(settings)
 
-    if settings['format'] == 'HTML':
-        filename = generate_HTML(
-            concatenated_markdown,
-            lexicon_file,
+    # Parse the lexicon once, to be shared by the dictionary and the lexicon
+    # substitution.
+    with metrics.span('lexicon_parse') as span:
+        lexicon = load_lexicon(lexicon_file, lexicon_columns)
+        span['rows'] = len(lexicon)
+
+    # Several formats can be requested at once, separated by commas.
+    output_formats = [x.strip() for x in settings['format'].split(',')]
+
+    if len(output_formats) > 1:
+        return generate_formats(markdown_file_strings, lexicon,
+                                lexicon_columns, settings, output_formats)
+
+    return render_format(
+        output_formats[0],
+        markdown_file_strings,
+        lexicon,
+        lexicon_columns,
+        settings,
+        project=project_key(settings, markdown_file_strings))
+
+
+def render_format(output_format,
+                  markdown,
+                  lexicon,
+                  lexicon_columns,
+                  settings,
+                  project=None):
+    '''Render a single output format. Returns the artifact's filename. The
+    project is the key returned by project_key.'''
+    if output_format == 'HTML':
+        return generate_HTML(
+            markdown,
+            lexicon,
             lexicon_columns=lexicon_columns,
             theme=settings['theme'],
             title=settings['grammarTitle'],
             subtitle=settings['grammarSubtitle'],
-            author=settings['author'])
-    elif settings['format'] == 'LaTeX PDF':
-        filename = generate_latex(
-            concatenated_markdown,
-            lexicon_file,
+            author=settings['author'],
+            lexicon_definitions=settings.get('lexiconDefinitions') or 'inline')
+    elif output_format == 'LaTeX PDF':
+        return generate_latex(
+            markdown,
+            lexicon,
             lexicon_columns=lexicon_columns,
             layout=settings['layout'],
             title=settings['grammarTitle'],
             subtitle=settings['grammarSubtitle'],
-            author=settings['author'])
+            author=settings['author'],
+            project=project)
+    else:
+        raise Exception('Unknown format: ' + str(output_format))
+
+
+def generate_formats(markdown, lexicon, lexicon_columns, settings,
+                     output_formats):
+    '''Render several output formats of the same grammar, and return the
+    filename of a zip archive containing them all. The markdown is read
+    into pandoc's JSON AST once, and each format's filter and writer run on
+    a copy of it, in parallel.'''
+    job_directory = tempfile.mkdtemp(dir=scratch_directory)
+    filenames = []
 
-    return filename
+    # The project is identified by the chapters as uploaded, before they are
+    # read into a single document.
+    project = project_key(settings, markdown)
+
+    try:
+        document = read_document(as_chapters(markdown), job_directory)
+
+        # Each format runs in its own thread, recording its spans to this
+        # render's recording. The writers and xelatex run in their own
+        # processes, so the formats overlap.
+        spans = metrics.current()
+
+        def render_in_thread(output_format):
+            with metrics.using(spans):
+                filename = render_format(
+                    output_format,
+                    document,
+                    lexicon,
+                    lexicon_columns,
+                    settings,
+                    project=project)
+                filenames.append(filename)
+                return filename
+
+        with ThreadPoolExecutor(max_workers=len(output_formats)) as executor:
+            outputs = list(executor.map(render_in_thread, output_formats))
+
+        artifact_filename = '{0}.zip'.format(uuid.uuid4().hex)
+        artifact_path = os.path.join(temp_directory, artifact_filename)
+
+        partial_path = os.path.join(job_directory, artifact_filename)
+
+        with metrics.span('file_write') as span:
+            with zipfile.ZipFile(partial_path, 'w') as archive:
+                for filename in outputs:
+                    extension = os.path.splitext(filename)[1]
+
+                    # PDFs are already compressed.
+                    archive.write(
+                        os.path.join(temp_directory, filename),
+                        'Grammar' + extension,
+                        compress_type=zipfile.ZIP_STORED if extension ==
+                        '.pdf' else zipfile.ZIP_DEFLATED)
+
+            os.replace(partial_path, artifact_path)
+            span['bytes'] = os.path.getsize(artifact_path)
+
+    finally:
+        shutil.rmtree(job_directory, ignore_errors=True)
+
+        # Only the archive is kept. The reaper may already have removed a
+        # format's file, which must not hide the result of the render.
+        for filename in filenames:
+            for path in variants(os.path.join(temp_directory, filename)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    return artifact_filename
 
 
 def read_lexicon_columns(settings):
@@ -102,11 +301,11 @@ def read_lexicon_columns(settings):
         'csvColumnPartOfSpeech': 'part_of_speech'
     }
 
-    columns = {}
+    columns = dict(LEXICON_COLUMN_DEFAULTS)
 
     # Add an entry to overrides for each column included in the request.
     for old, new in equivalents.items():
-        if old in settings:
+        if settings.get(old) is not None:
             columns[new] = int(settings[old]) - 1
 
     return columns
@@ -118,39 +317,26 @@ def generate_latex(markdown,
                    title='My language',
                    subtitle='A grammar',
                    author='An author',
-                   layout='A4'):
-    '''Takes a markdown string, a lexicon CSV string, and a number of settings.
-    Creates a PDF document and returns the filename.'''
+                   layout='A4',
+                   project=None):
+    '''Takes a markdown string, a list of markdown chapters or a document read
+    by read_document, a lexicon (a CSV string or a Lexicon), and a number of
+    settings. Creates a PDF document and returns the filename.
+
+    If a project key from project_key is given, the LaTeX cross-reference
+    state of the project's last build is reused.'''
 
-    template_directory = os.path.join(base_directory, 'themes', 'latex')
-    image_path = os.path.join(template_directory, 'images')
+    image_path = os.path.join(latex_template_directory, 'images')
 
-    # Create the lexicon as a LaTeX string.
-    dictionary_string = create_latex_dictionary(lexicon, lexicon_columns)
+    lexicon = load_lexicon(lexicon, lexicon_columns)
 
     # Create a metadata block and add it to the beginning of the markdown
     # string.
     year = time.strftime('%Y')
 
-    layouts = {
-        'A4': {
-            'papersize': 'a4paper',
-            'geometry': 'top=3cm,bottom=3cm,left=3cm,right=3cm,headsep=10pt,',
-            'fontsize': '11pt'
-        },
-        'A5': {
-            'papersize':
-            'a5paper',
-            'geometry':
-            'top=1.5cm,bottom=1.5cm,left=1.75cm,right=1.75cm,headsep=10pt,',
-            'fontsize':
-            '12pt'
-        }
-    }
-
-    paper = layouts[layout]['papersize']
-    font = layouts[layout]['fontsize']
-    geometry = layouts[layout]['geometry']
+    paper = LATEX_LAYOUTS[layout]['papersize']
+    font = LATEX_LAYOUTS[layout]['fontsize']
+    geometry = LATEX_LAYOUTS[layout]['geometry']
 
     metadata = {
         'title': title,
@@ -160,58 +346,107 @@ def generate_latex(markdown,
         'fontsize': font,
         'papersize': paper,
         'geometry': geometry,
-        'dictionary': dictionary_string,
         'imagepath': image_path
     }
 
     # Format metadata as YAML and add it before the rest of the file.
-    markdown = '---\n' + yaml.dump(metadata) + '\n---\n' + markdown
+    with metrics.span('metadata'):
+        chapters = ['---\n' + yaml.dump(metadata) + '\n---\n'] + as_chapters(
+            markdown)
 
     # Create list of pandoc settings, including template file
     pandoc_arguments = [
-        '--standalone', '--toc', '--smart', '--latex-engine=xelatex',
+        '--standalone', '--toc', '--latex-engine=xelatex',
         '--top-level-division=chapter'
     ]
 
     template_name = 'Default.tex'
-    template_path = os.path.join(template_directory, template_name)
+    template_path = os.path.join(latex_template_directory, template_name)
     pandoc_arguments.append('--template={0}'.format(template_path))
 
-    # Create temporary filename for output
-    temp_filename = str(time.time())
-    temp_path = os.path.join(base_directory, 'temp', temp_filename)
+    # Work in a scratch directory of our own, so that concurrent renders
+    # never share files.
+    job_directory = tempfile.mkdtemp(dir=scratch_directory)
+    artifact_filename = '{0}.pdf'.format(uuid.uuid4().hex)
 
-    # Define the filters to use
-    filter_path = os.path.join(base_directory, 'filters', 'LaTeX.py')
+    # Stream the lexicon as LaTeX into a file next to the TeX file, which the
+    # template includes with \input. This keeps the dictionary out of the
+    # YAML metadata, so neither yaml.dump nor pandoc has to process it.
+    with metrics.span('dictionary', rows=len(lexicon)) as span:
+        with open(os.path.join(job_directory, 'dictionary.tex'), 'w',
+                  encoding='utf-8') as f:
+            f.writelines(iter_latex_dictionary(lexicon, lexicon_columns))
+            span['bytes'] = f.tell()
+
+    pandoc_arguments.append('--variable=dictionaryfile:dictionary.tex')
 
     try:
         # Create the TeX file with Pandoc
-        pypandoc.convert_text(
-            markdown,
-            format='md',
-            to='tex',
-            outputfile=temp_path + '.tex',
-            extra_args=pandoc_arguments,
-            filters=[filter_path])
-
-        # Compile to PDF using xelatex (must be run twice)
-        os.chdir(os.path.join(base_directory, 'temp'))
-        call(['xelatex', '{0}'.format(temp_filename + '.tex')])
-        call(['xelatex', '{0}'.format(temp_filename + '.tex')])
-
-        # Clean up XeTeX junk files
-        for suffix in JUNK_FILE_SUFFIXES:
-            os.remove('{0}.{1}'.format(temp_path, suffix))
+        write_with_filter(
+            read_markdown(chapters, job_directory),
+            'tex',
+            latex_filter,
+            writer_arguments=pandoc_arguments,
+            outputfile=os.path.join(job_directory, 'grammar.tex'))
+
+        # Compile to PDF using xelatex, reusing the cross-reference state of
+        # earlier builds of the same grammar.
+        with metrics.span('xelatex') as span:
+            passes = compile_pdf(
+                'grammar',
+                job_directory,
+                state_directory=os.path.join(latex_state_directory, project)
+                if project is not None else None,
+                format_directory=latex_format_directory)
+
+            span['passes'] = len(passes)
+            span['pass_seconds'] = [round(x, 3) for x in passes]
+
+        pdf_path = os.path.join(job_directory, 'grammar.pdf')
+        if not os.path.exists(pdf_path):
+            raise Exception('xelatex did not produce a PDF')
+
+        with metrics.span('file_write', bytes=os.path.getsize(pdf_path)):
+            os.replace(pdf_path,
+                       os.path.join(temp_directory, artifact_filename))
 
     except Exception as e:
         print(str(type(e).__name__) + ': ' + str(e))
         raise Exception('Error in Pandoc conversion:' + str(e))
 
-    with open(os.path.join(base_directory, 'error.log'), 'w') as f:
-        f.write("Latex generation is returning: " +
-                '{0}.pdf'.format(temp_filename))
+    finally:
+        # Clean up the TeX source and XeTeX junk files, even on failure.
+        shutil.rmtree(job_directory, ignore_errors=True)
 
-    return '{0}.pdf'.format(temp_filename)
+    return artifact_filename
+
+
+def project_key(settings, markdown):
+    '''Return a key identifying a grammar project across builds, used to keep
+    its LaTeX cross-reference state, or None if the project cannot be told
+    apart from others.
+
+    A project is identified by its project setting if there is one.
+    Otherwise it is identified by the names its chapters were uploaded under,
+    together with its title, subtitle, author and layout. Chapters given as
+    strings have no names, so their builds never share state.'''
+    if settings.get('project'):
+        parts = ['project', settings['project'], settings.get('layout')]
+    else:
+        names = [getattr(x, 'name', None) for x in as_chapters(markdown)]
+        if not names or None in names:
+            return None
+
+        parts = [
+            settings.get('grammarTitle'),
+            settings.get('grammarSubtitle'),
+            settings.get('author'),
+            settings.get('layout')
+        ] + names
+
+    project = '\0'.join(x or '' for x in parts)
+
+    return hashlib.sha256(project.encode('utf-8')).hexdigest()
 
 
 def generate_HTML(markdown,
@@ -220,9 +455,17 @@ def generate_HTML(markdown,
                   theme='Default',
                   title='My language',
                   subtitle='A grammar',
-                  author='An author'):
-    '''Takes a markdown string, a lexicon CSV string, and a number of settings.
-    Creates a full HTML document and returns the filename.'''
+                  author='An author',
+                  lexicon_definitions='inline'):
+    '''Takes a markdown string, a list of markdown chapters or a document read
+    by read_document, a lexicon (a CSV string or a Lexicon), and a number of
+    settings. Creates a full HTML document and returns the filename.
+
+    With lexicon_definitions='inline', each lexicon reference is replaced with
+    its full definition. With 'table', each definition is written once, in a
+    lookup table which the theme's script uses to show definitions.'''
+
+    lexicon = load_lexicon(lexicon, lexicon_columns)
 
     # Create a metadata block and add it to the beginning of the markdown
     # string.
@@ -232,188 +475,367 @@ def generate_HTML(markdown,
         'date': time.strftime('%d/%m/%Y')
     }
 
-    # Format metadata as YAML and add it before the rest of the file.
-    markdown = '---\n' + yaml.dump(metadata) + '\n---\n' + markdown
+    # Create list of pandoc settings, including the theme's header bundle
+    pandoc_arguments = [
+        '--standalone', '--toc', '--html-q-tags',
+        '--include-in-header={0}'.format(theme_registry.bundle(theme))
+    ]
+
+    # Work in a scratch directory of our own, so that concurrent renders
+    # never share files.
+    job_directory = tempfile.mkdtemp(dir=scratch_directory)
+    dictionary_path = os.path.join(job_directory, 'dictionary.md')
+
+    try:
+        # Stream the lexicon to a file as Markdown, so the dictionary is never
+        # held in memory. It is read as a final chapter.
+        with metrics.span('dictionary', rows=len(lexicon)) as span:
+            with open(dictionary_path, 'w', encoding='utf-8') as f:
+                f.writelines(iter_html_dictionary(lexicon, lexicon_columns))
+                span['bytes'] = f.tell()
+
+        # Format metadata as YAML and add it before the rest of the file.
+        with metrics.span('metadata'):
+            chapters = [
+                '---\n' + yaml.dump(metadata) + '\n---\n'
+            ] + as_chapters(markdown) + [MarkdownFile(dictionary_path)]
+
+        # Get the generated HTML as a string
+        html = write_with_filter(
+            read_markdown(chapters, job_directory),
+            'html',
+            html_filter,
+            writer_arguments=pandoc_arguments)
+
+        # Replace dictionary words in the HTML with their definitions
+        with metrics.span('lexicon_substitution', bytes=len(html)):
+            if lexicon_definitions == 'table':
+                html = link_words_to_lexicon(html, lexicon, lexicon_columns)
+            else:
+                html = load_words_from_lexicon(html, lexicon,
+                                               lexicon_columns)
+
+        # Save the HTML in the scratch directory, and move it into the temp
+        # directory once it is complete, so the reaper never adopts a
+        # half-written file.
+        artifact_filename = '{0}.html'.format(uuid.uuid4().hex)
+        partial_path = os.path.join(job_directory, artifact_filename)
+
+        with metrics.span('file_write', bytes=len(html)):
+            with open(partial_path, 'w') as f:
+                f.write(html)
+
+        # Precompress the HTML, so downloads can be served compressed.
+        with metrics.span('compress', bytes=len(html)):
+            compress_artifact(partial_path)
+
+        # The compressed variants go first, so that they are in place by the
+        # time the artifact is found.
+        for path in reversed(variants(partial_path)):
+            os.replace(
+                path,
+                os.path.join(temp_directory, os.path.basename(path)))
+    finally:
+        shutil.rmtree(job_directory, ignore_errors=True)
+
+    return artifact_filename
+
+
+def as_chapters(markdown):
+    '''Return a markdown string, a document which has already been read or a
+    list of chapters as a list of chapters.'''
+    if isinstance(markdown, (str, dict)):
+        return [markdown]
+
+    return list(markdown)
+
+
+def read_document(chapters, job_directory):
+    '''Read a list of chapters (markdown strings, MarkdownFiles or documents
+    which have already been read) into a single pandoc JSON AST. Chapters are
+    read in parallel, and each chapter's AST is cached, so only changed
+    chapters are read again.'''
+    if has_labelled_examples(chapters):
+        # Labelled examples are numbered while pandoc reads them, so the
+        # chapters between documents which have already been read must be
+        # read together.
+        joined_chapters = []
+        for is_document, group in groupby(chapters,
+                                          lambda x: isinstance(x, dict)):
+            if is_document:
+                joined_chapters.extend(group)
+            else:
+                joined_chapters.append(
+                    concatenate_chapters(
+                        list(group),
+                        os.path.join(job_directory, 'chapters-{0}.md'.format(
+                            len(joined_chapters)))))
+
+        chapters = joined_chapters
+
+    return read_chapters(
+        chapters, READER_ARGUMENTS, chapter_cache, max_workers=chapter_workers)
+
+
+def read_markdown(chapters, job_directory):
+    '''Read a list of chapters into a single pandoc JSON AST string.'''
+    return json.dumps(read_document(chapters, job_directory))
+
+
+def write_with_filter(ast,
+                      to,
+                      filter_module,
+                      writer_arguments,
+                      outputfile=None):
+    '''Apply a filter module to a pandoc JSON AST string and write the result
+    with pandoc.'''
+    timings = Timings()
+
+    with metrics.span('filter', bytes=len(ast)):
+        doc = filter_module.main(pf.load(io.StringIO(ast)), timings=timings)
+
+        with io.StringIO() as f:
+            pf.dump(doc, f)
+            filtered_ast = f.getvalue()
+
+    # Record the time spent on each type of element, e.g. filter_Para.
+    for name, count, seconds in timings.items():
+        metrics.record('filter_' + name, seconds, nodes=count)
+
+    with metrics.span('pandoc_write', bytes=len(filtered_ast)):
+        return pandoc.convert_text(
+            filtered_ast,
+            format='json',
+            to=to,
+            extra_args=writer_arguments,
+            outputfile=outputfile)
+
+
+def convert_with_filter(markdown,
+                        to,
+                        filter_module,
+                        reader_arguments=(),
+                        writer_arguments=(),
+                        outputfile=None):
+    '''Convert a markdown string with pandoc, applying a filter module in
+    this process. Pandoc reads the markdown into its
+    JSON AST, the filter runs on the AST and pandoc writes the result, which
+    avoids starting a Python interpreter for the filter on every request.'''
+    ast = pandoc.convert_text(
+        markdown, format='md', to='json', extra_args=reader_arguments)
+
+    return write_with_filter(ast, to, filter_module, writer_arguments,
+                             outputfile)
+
+
+def compile_entry_template(template):
+    '''Convert a dictionary entry template to a format string which takes an
+    Entry, e.g. $word becomes {0.word}. Formatting is several times faster
+    than substituting a string.Template.'''
+    parts = []
+    position = 0
 
-    # Create the lexicon as a Markdown string and add it to the end of the
-    # file.
-    dictionary_string = create_html_dictionary(lexicon, lexicon_columns)
-    markdown = markdown + '\n\n' + dictionary_string
+    for match in string.Template.pattern.finditer(template):
+        literal = template[position:match.start()]
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
 
-    # Create list of pandoc settings, including theme files
-    pandoc_arguments = ['--standalone', '--toc', '--smart', '--html-q-tags']
+        if match.group('escaped') is not None:
+            parts.append('$')
+        else:
+            name = match.group('named') or match.group('braced')
+            parts.append('{0.' + name + '}')
 
-    html_name = '{0}.html'.format(theme)
-    css_name = '{0}.css'.format(theme)
+        position = match.end()
 
-    theme_directory = os.path.join(base_directory, 'themes', 'html')
+    literal = template[position:]
+    parts.append(literal.replace('{', '{{').replace('}', '}}'))
+
+    return ''.join(parts)
+
+
+def dictionary_template():
+    '''Return the LaTeX dictionary template, reading it on first use.'''
+    global _dictionary_template
 
-    header_files = [html_name, 'before.html', css_name, 'after.html']
+    if _dictionary_template is None:
+        with open(os.path.join(latex_template_directory, 'Dictionary.tex'),
+                  encoding='utf-8') as f:
+            _dictionary_template = f.read()
 
-    for filename in header_files:
-        full_path = os.path.join(theme_directory, filename)
-        pandoc_arguments.append('--include-in-header={0}'.format(full_path))
+    return _dictionary_template
 
-    # Define the filters to use
-    filter_path = os.path.join(base_directory, 'filters', 'HTML.py')
 
-    # Get the generated HTML as a string
-    html = pypandoc.convert_text(
-        markdown,
-        format='md',
-        to='html',
-        extra_args=pandoc_arguments,
-        filters=[filter_path])
+def split_template(template, name):
+    '''Split a string.Template around its single $name placeholder, so that
+    the placeholder's contents can be streamed between the two halves.'''
+    marker = '\0'
+    head, tail = string.Template(template).substitute({name: marker}).split(
+        marker)
 
-    # Replace dictionary words in the HTML with their definitions
-    html = load_words_from_lexicon(html, lexicon, lexicon_columns)
+    return head, tail
 
-    # Save the HTML to a temporary file
-    temp_filename = '{0}.html'.format(str(time.time()))
 
-    with open(os.path.join(base_directory, 'temp', temp_filename), 'w') as f:
-        f.write(html)
+def iter_entries(entry_format, entries):
+    '''Yield the formatted entries in chunks of about DICTIONARY_CHUNK_SIZE
+    characters.'''
+    chunk = []
+    size = 0
 
-    return temp_filename
+    for entry in entries:
+        text = entry_format.format(entry)
+        chunk.append(text)
+        size += len(text)
 
+        if size >= DICTIONARY_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
 
-def create_html_dictionary(lexicon_string, lexicon_columns):
-    '''Convert the given lexicon string to a Markdown dictionary string for use in
-    HTML.'''
-    definitions = ''
+    if chunk:
+        yield ''.join(chunk)
+
+
+def iter_html_dictionary(lexicon, lexicon_columns):
+    '''Yield the Markdown dictionary for use in HTML as a series of string
+    chunks, for the given lexicon (a CSV string or a Lexicon).'''
 
     # Group words by letter
-    groups = get_lexicon_groups(lexicon_string, lexicon_columns)
+    groups = load_lexicon(lexicon, lexicon_columns).groups()
 
     # If the lexicon is blank, don't include it
     if len(groups) == 0:
-        return ''
+        return
 
-    entry_template = string.Template(HTML_DICTIONARY_ENTRY_TEMPLATE)
+    head, tail = split_template(HTML_DICTIONARY_TEMPLATE, 'definitions')
+    entry_format = compile_entry_template(HTML_DICTIONARY_ENTRY_TEMPLATE)
+
+    yield head
 
     for group in groups:
-        for word in group[1]:
-            entry = entry_template.substitute(word)
-            definitions += entry
+        yield from iter_entries(entry_format, group[1])
 
-    # Substitute the created string into the template.
-    return string.Template(HTML_DICTIONARY_TEMPLATE).substitute(
-        definitions=definitions)
+    yield tail
 
 
-def create_latex_dictionary(lexicon_string, lexicon_columns):
-    '''Convert the given lexicon string to a LaTeX dictionary string.'''
-    definitions = ''
+def iter_latex_dictionary(lexicon, lexicon_columns):
+    '''Yield the LaTeX dictionary as a series of string chunks, for the given
+    lexicon (a CSV string or a Lexicon).'''
 
     # Group words by letter
-    groups = get_lexicon_groups(lexicon_string, lexicon_columns)
+    groups = load_lexicon(lexicon, lexicon_columns).groups()
 
     # If the lexicon is blank, don't include it
     if len(groups) == 0:
-        return ''
+        return
+
+    head, tail = split_template(dictionary_template(), 'definitions')
+    entry_format = compile_entry_template(DICTIONARY_ENTRY_TEMPLATE)
 
-    entry_template = string.Template(DICTIONARY_ENTRY_TEMPLATE)
+    yield head
 
     for group in groups:
         # Add letter label
-        definitions += '\\section*{' + group[0].upper() + '}'
+        yield '\\section*{' + group[0].upper() + '}'
 
-        definitions += '\\begin{multicols*}{2}'
+        yield '\\begin{multicols*}{2}'
 
-        for word in group[1]:
-            entry = entry_template.substitute(word)
-            definitions += entry
+        yield from iter_entries(entry_format, group[1])
 
-        definitions += '\\end{multicols*}'
+        yield '\\end{multicols*}'
 
-    # Substitute the created string into the template.
-    return string.Template(DICTIONARY_TEMPLATE).substitute(
-        definitions=definitions)
+    yield tail
 
 
-def get_lexicon_groups(lexicon_string, lexicon_columns):
-    '''Given a lexicon string, return a list. Each item is a tuple, where the first
-    item is a letter and the second is a list of word dictionaries that begin with
-    that letter.'''
-    groups = []
+def create_html_dictionary(lexicon, lexicon_columns):
+    '''Convert the given lexicon (a CSV string or a Lexicon) to a Markdown
+    dictionary string for use in HTML.'''
+    return ''.join(iter_html_dictionary(lexicon, lexicon_columns))
 
-    # Read the lexicon string as a CSV file, deleting the header row.
-    lexicon_dicts = convert_lexicon(lexicon_string, lexicon_columns)
 
-    # Convert to a list.
-    lexicon = list(zip(lexicon_dicts.keys(), lexicon_dicts.values()))
+def create_latex_dictionary(lexicon, lexicon_columns):
+    '''Convert the given lexicon (a CSV string or a Lexicon) to a LaTeX
+    dictionary string.'''
+    return ''.join(iter_latex_dictionary(lexicon, lexicon_columns))
 
-    # Sort alphabetically
-    lexicon = sorted(lexicon, key=lambda x: x[0])
 
-    # Group by first letter
-    for first_letter, words in groupby(lexicon, lambda x: x[0][0]):
-        # Add the conlang word to each word dictionary
-        modified_words = []
-        for word in words:
-            modified_word = word[1]
-            modified_word['word'] = word[0]
-            modified_words.append(modified_word)
+def load_words_from_lexicon(html, lexicon, lexicon_columns):
+    '''Replace all words surrounded by double curly braces in the HTML string
+    (created by the filter) with their dictionary definition according to the
+    given lexicon (a CSV string or a Lexicon).'''
+    lexicon = load_lexicon(lexicon, lexicon_columns)
+
+    # Each word's definition HTML is only built once, however many times the
+    # word is used.
+    definitions = {}
+
+    def substitute_definition(match):
+        word = match.group(1)
+
+        try:
+            return definitions[word]
+        except KeyError:
+            pass
+
+        entry = lexicon.get(word)
+        if entry is None:
+            # Leave words missing from the lexicon untouched.
+            definition_HTML = match.group(0)
+        else:
+            definition_HTML = DEFINITION_BLOCK.substitute(
+                word=word,
+                local_word=entry.local_word,
+                definition=entry.definition,
+                part=entry.part_of_speech)
 
-        groups.append((first_letter, modified_words))
+        definitions[word] = definition_HTML
+        return definition_HTML
 
-    return groups
+    # Substitute every match in a single pass over the document.
+    return LEXICON_REFERENCE.sub(substitute_definition, html)
 
 
-def load_words_from_lexicon(html, lexicon_string, lexicon_columns):
+def link_words_to_lexicon(html, lexicon, lexicon_columns):
     '''Replace all words surrounded by double curly braces in the HTML string
-    (created by the filter) with their dictionary definition according to the
-    given lexicon.'''
+    with the bare word, and add a JSON lookup table of the definitions of the
+    words used before the end of the body. Each definition appears once,
+    however many times its word is used.'''
+    lexicon = load_lexicon(lexicon, lexicon_columns)
 
-    # Read the lexicon string as a CSV file.
-    lexicon = convert_lexicon(lexicon_string, lexicon_columns)
+    # Maps each word used to its local word, part of speech and definition.
+    table = {}
 
-    match_list = re.findall(r'{{[a-z]*}}', html, re.I)
+    def substitute_reference(match):
+        word = match.group(1)
 
-    for match in match_list:
-        word = match[2:-2]
-        try:
-            local_word = lexicon[word]['local_word']
-            definition = lexicon[word]['definition']
-            part = lexicon[word]['part_of_speech']
+        if word not in table:
+            entry = lexicon.get(word)
+            if entry is None:
+                # Leave words missing from the lexicon untouched.
+                return match.group(0)
 
-            definition_block = string.Template(DEFINITION_TEMPLATE)
-            definition_HTML = definition_block.substitute(
-                word=word,
-                local_word=local_word,
-                definition=definition,
-                part=part)
+            table[word] = [
+                entry.local_word, entry.part_of_speech, entry.definition
+            ]
 
-            html = html.replace(match, definition_HTML)
+        return WORD_REFERENCE_TEMPLATE.format(word)
 
-        except KeyError:
-            pass
+    html = LEXICON_REFERENCE.sub(substitute_reference, html)
+
+    # Escape closing tags, so that a definition cannot end the script early.
+    table_HTML = LEXICON_TABLE_TEMPLATE.format(
+        json.dumps(table, ensure_ascii=False,
+                   separators=(',', ':')).replace('</', '<\\/'))
 
-    return html
+    position = html.rfind('</body>')
+    if position == -1:
+        return html + table_HTML
+
+    return html[:position] + table_HTML + html[position:]
 
 
 def convert_lexicon(lexicon_string, lexicon_columns):
     '''Convert a lexicon string (CSV) to a dictionary. Each key is a word and
     each value is a dictionary containing information about the word.'''
-    word_lines = list(csv.reader(lexicon_string.split('\n')))[1:]
+    lexicon = load_lexicon(lexicon_string, lexicon_columns)
 
-    lexicon = {}
-    for line in word_lines:
-        try:
-            word_data = {
-                'local_word': line[lexicon_columns['local']],
-                'definition': line[lexicon_columns['definition']],
-                'pronunciation': line[lexicon_columns['pronunciation']],
-                'part_of_speech': line[lexicon_columns['part_of_speech']]
-            }
-            lexicon[line[lexicon_columns['word']]] = word_data
-
-        except IndexError:
-            # Ignore empty lines
-            if len(line) != 0:
-                error = ('Could not correctly read CSV file! '
-                         'Check that your column numbers are correct. '
-                         'The error appears in the line: ' + ','.join(line))
-                raise Exception(error)
-
-    return lexicon
+    return {entry.word: entry.as_dict() for entry in lexicon}
@@ -0,0 +1,245 @@
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from src import metrics, pandoc
+from src.generate import render_with_spans
+from src.scheduler import Scheduler, default_limits, job_kind
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds to remember a finished job after it completes.
+JOB_RETENTION = 60 * 60
+
+# Render workers are started from a clean process rather than forked from
+# the web server, whose threads may hold locks at the time of the fork.
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    WORKER_START_METHOD = 'forkserver'
+else:
+    WORKER_START_METHOD = 'spawn'
+
+
+def format_error(e):
+    '''Format an exception in the form the front-end expects.'''
+    return 'ERROR' + str(type(e).__name__) + ': ' + str(e)
+
+
+def worker_pool(max_workers=None):
+    '''Return a new pool of render worker processes, which convert with the
+    pandoc servers currently running.'''
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+        initializer=pandoc.attach,
+        initargs=(pandoc.pool.ports(),))
+
+
+def remove_uploads(upload_directory):
+    if upload_directory is not None:
+        shutil.rmtree(upload_directory, ignore_errors=True)
+
+
+class Job:
+    '''A single render request. Jobs for identical requests share a future,
+    but each receives its own copy of the artifact.'''
+
+    def __init__(self, future):
+        self.id = uuid.uuid4().hex
+        self.future = future
+        self.filename = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+        # Timing spans of the render, which are empty for cached results.
+        self.spans = []
+
+    @property
+    def status(self):
+        if self.filename is not None:
+            return DONE
+        elif self.error is not None:
+            return FAILED
+        elif self.future is not None and self.future.running():
+            return RUNNING
+        else:
+            return QUEUED
+
+    def finish(self, filename):
+        self.filename = filename
+        self.finished = time.time()
+
+    def fail(self, error):
+        self.error = error
+        self.finished = time.time()
+
+    def xelatex(self):
+        '''Return the number and durations of the xelatex passes of a PDF
+        render, or None if the job ran none.'''
+        for s in self.spans:
+            if s.stage == 'xelatex':
+                return {
+                    'passes': s.attributes['passes'],
+                    'seconds': s.attributes['pass_seconds']
+                }
+
+        return None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'error': self.error,
+            'xelatex': self.xelatex()
+        }
+
+
+class JobQueue:
+    '''Runs renders in a bounded process pool, so that slow LaTeX builds never
+    block the web server. PDF and HTML builds are admitted separately, with
+    their own limits on running and queued builds; see Scheduler.'''
+
+    def __init__(self,
+                 cache,
+                 output_directory,
+                 max_workers=None,
+                 artifacts=None,
+                 limits=None):
+        self.cache = cache
+        self.output_directory = output_directory
+        self.artifacts = artifacts
+        self.scheduler = Scheduler(
+            lambda: worker_pool(max_workers),
+            limits or default_limits(max_workers or os.cpu_count()))
+
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._waiting = {}
+
+    def submit(self,
+               markdown_file_strings,
+               lexicon_file,
+               settings,
+               upload_directory=None):
+        '''Queue a render and return the new job's id. Cached requests finish
+        immediately, and requests identical to one already in progress wait
+        for its result instead of rendering again.
+
+        If the sources were uploaded to a directory, it is removed once they
+        are no longer needed.
+
+        Raises scheduler.Saturated if too many builds of the same kind are
+        queued.'''
+        try:
+            key = self.cache.key(markdown_file_strings, lexicon_file, settings)
+        except Exception:
+            remove_uploads(upload_directory)
+            raise
+
+        self._prune()
+
+        cached_path = self.cache.get(key)
+        if cached_path is not None:
+            remove_uploads(upload_directory)
+            job = Job(None)
+            self._finish(job, self.cache.checkout(cached_path,
+                                                  self.output_directory))
+            return self._add(job)
+
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if waiting is not None:
+                remove_uploads(upload_directory)
+                job = Job(waiting[0].future)
+                waiting.append(job)
+                self._jobs[job.id] = job
+                return job.id
+
+            try:
+                future = self.scheduler.submit(
+                    job_kind(settings), render_with_spans,
+                    markdown_file_strings, lexicon_file, settings)
+            except Exception:
+                remove_uploads(upload_directory)
+                raise
+
+            job = Job(future)
+            self._waiting[key] = [job]
+            self._jobs[job.id] = job
+
+        if self.artifacts is not None and upload_directory is not None:
+            self.artifacts.acquire_scratch(upload_directory)
+
+        future.add_done_callback(lambda f: self._complete(
+            key, f, upload_directory))
+
+        return job.id
+
+    def get(self, job_id):
+        '''Return the job with the given id, or None if it is unknown.'''
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        if self.scheduler.executor is not None:
+            self.scheduler.executor.shutdown(wait=False)
+
+    def _add(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+
+        return job.id
+
+    def _complete(self, key, future, upload_directory):
+        remove_uploads(upload_directory)
+        if self.artifacts is not None and upload_directory is not None:
+            self.artifacts.release_scratch(upload_directory)
+
+        with self._lock:
+            jobs = self._waiting.pop(key)
+
+        try:
+            filename, spans = future.result()
+            cached_path = self.cache.put(
+                key, os.path.join(self.output_directory, filename))
+        except Exception as e:
+            print(format_error(e))
+            for job in jobs:
+                job.fail(format_error(e))
+            return
+
+        metrics.registry.observe(spans)
+        for job in jobs:
+            job.spans = spans
+
+        # The first job takes the rendered file and the rest take copies.
+        self._finish(jobs[0], filename)
+        for job in jobs[1:]:
+            self._finish(job,
+                         self.cache.checkout(cached_path,
+                                             self.output_directory))
+
+    def _finish(self, job, filename):
+        if self.artifacts is not None:
+            self.artifacts.add(filename)
+
+        job.finish(filename)
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished is not None
+                and now - job.finished > JOB_RETENTION
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
@@ -0,0 +1,261 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from src import limits, metrics
+
+# Files which carry cross-reference state from one xelatex pass to the next.
+STATE_FILE_SUFFIXES = ['aux', 'toc', 'ptc']
+
+# Log messages which mean another pass is needed, even if the state files
+# have not changed.
+RERUN_MESSAGES = [b'Rerun to get', b'Label(s) may have changed']
+
+MAX_PASSES = 5
+
+# Marks the end of the part of a template's preamble which is dumped into a
+# format file. Without mylatexformat loaded, the command does nothing.
+DUMP_MARKER = '\\csname endofdump\\endcsname'
+
+# Seconds before a format which failed to build is tried again, e.g. after
+# mylatexformat has been installed.
+FAILED_FORMAT_RETRY = 24 * 60 * 60
+
+
+def state_digest(working_directory, jobname):
+    '''Return a digest of each of the job's state files, or None for files
+    which do not exist.'''
+    digests = {}
+
+    for suffix in STATE_FILE_SUFFIXES:
+        path = os.path.join(working_directory, '{0}.{1}'.format(
+            jobname, suffix))
+        try:
+            with open(path, 'rb') as f:
+                digests[suffix] = hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            digests[suffix] = None
+
+    return digests
+
+
+def rerun_requested(working_directory, jobname):
+    '''Return True if the last pass's log asks for LaTeX to be run again.'''
+    try:
+        with open(os.path.join(working_directory, jobname + '.log'),
+                  'rb') as f:
+            log = f.read()
+    except FileNotFoundError:
+        return False
+
+    return any(message in log for message in RERUN_MESSAGES)
+
+
+def copy_state(source_directory, source_jobname, destination_directory,
+               destination_jobname):
+    '''Copy the state files of one job to another, skipping missing files.'''
+    os.makedirs(destination_directory, exist_ok=True)
+
+    for suffix in STATE_FILE_SUFFIXES:
+        source = os.path.join(source_directory, '{0}.{1}'.format(
+            source_jobname, suffix))
+        destination = os.path.join(destination_directory, '{0}.{1}'.format(
+            destination_jobname, suffix))
+
+        if not os.path.exists(source):
+            continue
+
+        # Copy under a temporary name so that a concurrent build of the same
+        # project never reads a partial file.
+        partial = '{0}.{1}.partial'.format(destination, uuid.uuid4().hex)
+        shutil.copyfile(source, partial)
+        os.replace(partial, destination)
+
+
+def preamble_format(tex_path, format_directory):
+    '''Return the path, without extension, of a format file containing the
+    preamble of the TeX file up to the dump marker, building the format if
+    necessary. Formats are named after a digest of the preamble, so a change
+    to the template or its layout variables produces a new format.
+
+    Only one build of each format runs at once, under a lock file. A failed
+    build leaves a marker, so later builds compile from the full preamble
+    straight away rather than failing to build the format again, until the
+    marker is FAILED_FORMAT_RETRY seconds old.
+
+    Returns None if the file has no dump marker or the format cannot be
+    built.'''
+    preamble = []
+    with open(tex_path, encoding='utf-8') as f:
+        for line in f:
+            preamble.append(line)
+            if line.strip() == DUMP_MARKER:
+                break
+        else:
+            return None
+
+    preamble = ''.join(preamble)
+    name = 'preamble-' + hashlib.sha256(
+        preamble.encode('utf-8')).hexdigest()[:16]
+    format_path = os.path.join(format_directory, name)
+
+    status = format_status(format_path)
+    if status is not None:
+        return format_path if status else None
+
+    os.makedirs(format_directory, exist_ok=True)
+
+    with open(format_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        # Another build may have built the format, or failed to, while this
+        # one waited for the lock.
+        status = format_status(format_path)
+        if status is not None:
+            return format_path if status else None
+
+        if not build_format(preamble, name, format_path, format_directory):
+            mark_failed(format_path)
+            return None
+
+    # Forget an earlier failure, once the retry has succeeded.
+    try:
+        os.remove(format_path + '.failed')
+    except FileNotFoundError:
+        pass
+
+    return format_path
+
+
+def format_status(format_path):
+    '''Return True if the format has been built, False if building it failed
+    recently, or None if it should be built.'''
+    if os.path.exists(format_path + '.fmt'):
+        return True
+
+    try:
+        failed = os.path.getmtime(format_path + '.failed')
+    except FileNotFoundError:
+        return None
+
+    return False if time.time() - failed < FAILED_FORMAT_RETRY else None
+
+
+def mark_failed(format_path):
+    '''Record that a format cannot be built or used.'''
+    with open(format_path + '.failed', 'w'):
+        pass
+
+
+def build_format(preamble, name, format_path, format_directory):
+    '''Dump the preamble into a format file at format_path. Returns False if
+    the format could not be built.'''
+    # Build the format in its own directory, then move it into place so that
+    # other builds never see a partial file.
+    build_directory = tempfile.mkdtemp(
+        prefix=name + '.build.', dir=format_directory)
+
+    try:
+        with open(os.path.join(build_directory, name + '.tex'), 'w',
+                  encoding='utf-8') as f:
+            f.write(preamble)
+            f.write('\n\\begin{document}\n\\end{document}\n')
+
+        try:
+            limits.call(
+                [
+                    'xelatex', '-ini', '-interaction=nonstopmode',
+                    '-jobname=' + name, '&xelatex', 'mylatexformat.ltx',
+                    name + '.tex'
+                ],
+                cwd=build_directory)
+        except Exception as e:
+            print('Could not build LaTeX format {0}: {1}'.format(name, e))
+            return False
+
+        built_format = os.path.join(build_directory, name + '.fmt')
+        if not os.path.exists(built_format):
+            print('Could not build LaTeX format ' + name)
+            return False
+
+        os.replace(built_format, format_path + '.fmt')
+    finally:
+        shutil.rmtree(build_directory, ignore_errors=True)
+
+    return True
+
+
+def compile_pdf(jobname,
+                working_directory,
+                state_directory=None,
+                format_directory=None,
+                max_passes=MAX_PASSES):
+    '''Compile jobname.tex in the working directory to a PDF with xelatex. The
+    document is compiled again only while its cross-references are still
+    changing, up to max_passes times.
+
+    If a state directory is given, state files saved there by an earlier
+    build are restored before the first pass. The new state files are saved
+    after the last pass. An unchanged document then only needs one pass.
+
+    If a format directory is given, the preamble is precompiled into a format
+    file there, and every pass starts from the format instead of reading the
+    preamble's packages again.
+
+    Each pass runs with the CPU time, memory and wall time limits in
+    src.limits, and an exception is raised if a pass runs out of time.
+
+    Returns a list of the durations of each pass, in seconds.'''
+    if state_directory is not None:
+        copy_state(state_directory, 'state', working_directory, jobname)
+
+    command = ['xelatex', '-interaction=nonstopmode']
+    format_path = None
+
+    if format_directory is not None:
+        format_path = preamble_format(
+            os.path.join(working_directory, jobname + '.tex'),
+            format_directory)
+        if format_path is not None:
+            command.append('-fmt=' + format_path)
+
+    pdf_path = os.path.join(working_directory, jobname + '.pdf')
+    previous = state_digest(working_directory, jobname)
+    passes = []
+    unusable_format = None
+
+    while len(passes) < max_passes:
+        start = time.time()
+        limits.call(command + [jobname + '.tex'], cwd=working_directory)
+        passes.append(time.time() - start)
+        metrics.record('xelatex_pass', passes[-1])
+
+        if format_path is not None and not os.path.exists(pdf_path):
+            # The format may be unusable, e.g. after a TeX upgrade, so try
+            # again from the full preamble.
+            command.remove('-fmt=' + format_path)
+            unusable_format, format_path = format_path, None
+            continue
+
+        current = state_digest(working_directory, jobname)
+        if current == previous and not rerun_requested(working_directory,
+                                                       jobname):
+            break
+
+        previous = current
+
+    if unusable_format is not None and os.path.exists(pdf_path):
+        # The document compiles without the format, so the format was at
+        # fault.
+        print('Discarding unusable LaTeX format ' + unusable_format)
+        os.remove(unusable_format + '.fmt')
+        mark_failed(unusable_format)
+
+    if state_directory is not None:
+        copy_state(working_directory, jobname, state_directory, 'state')
+
+    return passes
@@ -0,0 +1,274 @@
+import csv
+import hashlib
+import json
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import groupby
+
+from src.cache import update_from_file, update_from_source
+
+LEXICON_COLUMN_DEFAULTS = {
+    'word': 0,
+    'local': 1,
+    'part_of_speech': 3,
+    'definition': 5,
+    'pronunciation': 2
+}
+
+# Number of parsed lexicons kept in memory for reuse by later requests.
+LEXICON_CACHE_SIZE = 16
+
+_lexicon_cache = OrderedDict()
+_lexicon_cache_lock = threading.Lock()
+
+# Number of uploaded lexicons kept in memory for queries.
+LEXICON_STORE_SIZE = 32
+
+# Default and largest number of entries returned by a prefix search.
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+class LexiconFile:
+    '''A CSV lexicon stored on disk, which is parsed as a stream rather than
+    being loaded into memory.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def digest(self):
+        digest = hashlib.sha256()
+        update_from_file(digest, self.path)
+
+        return digest.hexdigest()
+
+    def open(self):
+        return open(self.path, newline='', encoding='utf-8')
+
+
+class Entry:
+    '''A single word in the lexicon.'''
+    __slots__ = ('word', 'local_word', 'definition', 'pronunciation',
+                 'part_of_speech')
+
+    def __init__(self, word, local_word, definition, pronunciation,
+                 part_of_speech):
+        self.word = word
+        self.local_word = local_word
+        self.definition = definition
+        self.pronunciation = pronunciation
+        self.part_of_speech = part_of_speech
+
+    def as_dict(self):
+        '''Return the entry as a dictionary, for template substitution.'''
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class Lexicon:
+    '''A parsed lexicon, indexed by word. If a word appears more than once, the
+    last definition is used.'''
+
+    def __init__(self, entries):
+        self._index = {}
+        for entry in entries:
+            self._index[entry.word] = entry
+
+        self._groups = None
+        self._search_index = None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, word):
+        return word in self._index
+
+    def __getitem__(self, word):
+        return self._index[word]
+
+    def __iter__(self):
+        return iter(self._index.values())
+
+    def get(self, word, default=None):
+        return self._index.get(word, default)
+
+    def groups(self):
+        '''Return a list of tuples, where the first item is a letter and the
+        second is a list of entries that begin with that letter, in
+        alphabetical order. The list is built on first use.'''
+        if self._groups is None:
+            entries = sorted(self._index.values(), key=lambda x: x.word)
+
+            self._groups = [(first_letter, list(words))
+                            for first_letter, words in groupby(
+                                entries, lambda x: x.word[:1])]
+
+        return self._groups
+
+    def search_index(self):
+        '''Return the sorted keys and entries used for searches, as a
+        dictionary of field name to a (keys, entries) pair of parallel lists,
+        and a dictionary of local word to entries. The index is built on first
+        use.'''
+        if self._search_index is None:
+            by_word = sorted(self._index.values(), key=lambda x: x.word)
+            by_local = sorted(by_word, key=lambda x: x.local_word)
+
+            local_index = {}
+            for entry in by_local:
+                local_index.setdefault(entry.local_word, []).append(entry)
+
+            self._search_index = ({
+                'word': ([x.word for x in by_word], by_word),
+                'local': ([x.local_word for x in by_local], by_local)
+            }, local_index)
+
+        return self._search_index
+
+    def search(self, prefix, field='word', limit=DEFAULT_SEARCH_LIMIT):
+        '''Return up to limit entries whose word, or local word if field is
+        'local', starts with prefix, in alphabetical order.'''
+        sorted_fields, _ = self.search_index()
+        if field not in sorted_fields:
+            raise Exception('Unknown field: ' + str(field))
+
+        keys, entries = sorted_fields[field]
+
+        results = []
+        position = bisect_left(keys, prefix)
+        while (position < len(keys) and len(results) < limit
+               and keys[position].startswith(prefix)):
+            results.append(entries[position])
+            position += 1
+
+        return results
+
+    def get_local(self, local_word):
+        '''Return the entries with the given local word, which may be shared
+        by more than one word.'''
+        _, local_index = self.search_index()
+
+        return local_index.get(local_word, [])
+
+
+def parse_lexicon(lexicon_string, lexicon_columns):
+    '''Parse a lexicon string (CSV) or LexiconFile, skipping the header row,
+    and return a Lexicon. Files are read a line at a time.'''
+    if isinstance(lexicon_string, LexiconFile):
+        with lexicon_string.open() as f:
+            return parse_lines(csv.reader(f), lexicon_columns)
+
+    if not lexicon_string:
+        return Lexicon([])
+
+    return parse_lines(csv.reader(lexicon_string.split('\n')), lexicon_columns)
+
+
+def parse_lines(word_lines, lexicon_columns):
+    '''Return a Lexicon of the parsed CSV lines, skipping the header row.'''
+    next(word_lines, None)
+
+    return Lexicon(read_entries(word_lines, lexicon_columns))
+
+
+def read_entries(word_lines, lexicon_columns):
+    '''Yield an Entry for each parsed CSV line.'''
+    word_column = lexicon_columns['word']
+    local_column = lexicon_columns['local']
+    definition_column = lexicon_columns['definition']
+    pronunciation_column = lexicon_columns['pronunciation']
+    part_of_speech_column = lexicon_columns['part_of_speech']
+
+    for line in word_lines:
+        try:
+            yield Entry(line[word_column], line[local_column],
+                        line[definition_column], line[pronunciation_column],
+                        line[part_of_speech_column])
+
+        except IndexError:
+            # Ignore empty lines
+            if len(line) != 0:
+                error = ('Could not correctly read CSV file! '
+                         'Check that your column numbers are correct. '
+                         'The error appears in the line: ' + ','.join(line))
+                raise Exception(error)
+
+
+def lexicon_key(lexicon, lexicon_columns):
+    '''Return a digest of a lexicon string or LexiconFile and the columns it
+    is parsed with.'''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(lexicon_columns, sort_keys=True).encode())
+    update_from_source(digest, lexicon or '')
+
+    return digest.hexdigest()
+
+
+def load_lexicon(lexicon, lexicon_columns):
+    '''Return a Lexicon for the given lexicon string or LexiconFile. Lexicons
+    are cached by content, so identical lexicons across requests are only
+    parsed once. If lexicon is already a Lexicon, it is returned unchanged.'''
+    if isinstance(lexicon, Lexicon):
+        return lexicon
+
+    key = lexicon_key(lexicon, lexicon_columns)
+
+    with _lexicon_cache_lock:
+        if key in _lexicon_cache:
+            _lexicon_cache.move_to_end(key)
+            return _lexicon_cache[key]
+
+    parsed = parse_lexicon(lexicon, lexicon_columns)
+
+    with _lexicon_cache_lock:
+        _lexicon_cache[key] = parsed
+        while len(_lexicon_cache) > LEXICON_CACHE_SIZE:
+            _lexicon_cache.popitem(last=False)
+
+    return parsed
+
+
+class LexiconStore:
+    '''Uploaded lexicons kept in memory for queries, identified by a digest of
+    their content and columns. The least recently used lexicon is removed when
+    there are more than size.'''
+
+    def __init__(self, size=LEXICON_STORE_SIZE):
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._lexicons = OrderedDict()
+
+    def add(self, lexicon, lexicon_columns):
+        '''Parse and index a lexicon string or LexiconFile, and return its
+        id.'''
+        key = lexicon_key(lexicon, lexicon_columns)
+
+        with self._lock:
+            if key in self._lexicons:
+                self._lexicons.move_to_end(key)
+                return key
+
+        parsed = load_lexicon(lexicon, lexicon_columns)
+
+        # Build the index now, so that no query has to.
+        parsed.search_index()
+
+        with self._lock:
+            self._lexicons[key] = parsed
+            while len(self._lexicons) > self.size:
+                self._lexicons.popitem(last=False)
+
+        return key
+
+    def get(self, key):
+        '''Return the lexicon with the given id, or None if there is none.'''
+        with self._lock:
+            lexicon = self._lexicons.get(key)
+            if lexicon is not None:
+                self._lexicons.move_to_end(key)
+
+        return lexicon
+
+    def __len__(self):
+        return len(self._lexicons)
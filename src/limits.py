@@ -0,0 +1,85 @@
+import os
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Limits on each pandoc and xelatex process started by a render, so that a
+# pathological document fails instead of starving every other job.
+DEFAULT_CPU_SECONDS = 300
+DEFAULT_MEMORY_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_TIMEOUT = 600
+
+cpu_seconds = int(os.environ.get('CODA_PROCESS_CPU_SECONDS',
+                                 DEFAULT_CPU_SECONDS))
+memory_bytes = int(os.environ.get('CODA_PROCESS_MEMORY',
+                                  DEFAULT_MEMORY_BYTES))
+timeout = int(os.environ.get('CODA_PROCESS_TIMEOUT', DEFAULT_TIMEOUT))
+
+
+def set_limit(pid, kind, value):
+    '''Lower a process's soft limit of a resource to value, or to its hard
+    limit if that is lower.'''
+    _, hard = resource.prlimit(pid, kind)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+
+    resource.prlimit(pid, kind, (value, hard))
+
+
+def apply_limits(pid, limit_memory=True):
+    '''Limit the CPU time and, if limit_memory is set, the address space of a
+    running process. The limits are applied from outside the process with
+    prlimit, rather than in a preexec_fn, which is unsafe when other threads
+    are running. They are skipped where prlimit is unavailable.'''
+    if resource is None or not hasattr(resource, 'prlimit'):
+        return
+
+    try:
+        set_limit(pid, resource.RLIMIT_CPU, cpu_seconds)
+        if limit_memory:
+            set_limit(pid, resource.RLIMIT_AS, memory_bytes)
+    except ProcessLookupError:
+        # The process has already finished.
+        pass
+
+
+def run(command, input=None, cwd=None, limit_memory=True):
+    '''Run a command with the CPU time, memory and wall time limits. Returns
+    the exit code and, if input is given, the command's output and error
+    output as bytes; otherwise they are inherited and returned as None.
+
+    The command is killed if it runs for longer than the time limit, and an
+    exception is raised.'''
+    pipe = subprocess.PIPE if input is not None else None
+
+    process = subprocess.Popen(
+        command, cwd=cwd, stdin=pipe, stdout=pipe, stderr=pipe)
+    apply_limits(process.pid, limit_memory)
+
+    try:
+        output, error = process.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise Exception('{0} took longer than {1} seconds'.format(
+            os.path.basename(command[0]), timeout))
+
+    return process.returncode, output, error
+
+
+def call(command, cwd=None):
+    '''Run a command with the CPU time, memory and wall time limits, like
+    subprocess.call.'''
+    returncode, _, _ = run(command, cwd=cwd)
+
+    return returncode
+
+
+def pandoc_arguments():
+    '''Return pandoc arguments which limit its heap to the memory limit.
+    Pandoc's runtime reserves far more address space than it uses, so its
+    memory is limited by the runtime instead of an rlimit.'''
+    return ['+RTS', '-M{0}'.format(memory_bytes), '-RTS']
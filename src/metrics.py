@@ -0,0 +1,164 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets for span durations, in seconds.
+SECONDS_BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+]
+
+# Upper bounds of the histogram buckets for each span attribute. Attributes
+# without buckets are kept on the span but not aggregated.
+ATTRIBUTE_BUCKETS = {
+    'bytes': [1024 * 4**x for x in range(10)],
+    'rows': [10, 100, 1000, 10000, 100000, 1000000]
+}
+
+_local = threading.local()
+
+
+class Span:
+    '''The duration of one stage of a render, with attributes describing the
+    work done, such as the size of the document in bytes or the number of
+    rows in the lexicon.'''
+    __slots__ = ('stage', 'seconds', 'attributes')
+
+    def __init__(self, stage, seconds, attributes):
+        self.stage = stage
+        self.seconds = seconds
+        self.attributes = attributes
+
+
+def current():
+    '''Return the list spans are being recorded to in this thread, or
+    None.'''
+    return getattr(_local, 'spans', None)
+
+
+@contextmanager
+def using(spans):
+    '''Record spans in this thread to the given list, which may be None. Used
+    to carry a recording into worker threads.'''
+    previous = current()
+    _local.spans = spans
+    try:
+        yield spans
+    finally:
+        _local.spans = previous
+
+
+@contextmanager
+def recording():
+    '''Record the spans of everything run in the block, yielding the list
+    they are recorded to.'''
+    with using([]) as spans:
+        yield spans
+
+
+@contextmanager
+def span(stage, **attributes):
+    '''Time the block as a stage. Yields the span's attributes, so that sizes
+    only known at the end of the stage can be added. Nothing is recorded
+    outside of a recording.'''
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        record(stage, time.perf_counter() - start, **attributes)
+
+
+def record(stage, seconds, **attributes):
+    '''Record a stage which has already been timed.'''
+    spans = current()
+    if spans is not None:
+        spans.append(Span(stage, seconds, attributes))
+
+
+def server_timing(spans):
+    '''Format spans as a Server-Timing header, adding together the durations
+    of repeated stages such as xelatex passes.'''
+    totals = {}
+    for s in spans:
+        totals[s.stage] = totals.get(s.stage, 0) + s.seconds
+
+    return ', '.join('{0};dur={1:.1f}'.format(stage, seconds * 1000)
+                     for stage, seconds in totals.items())
+
+
+class Histogram:
+    '''A Prometheus-style histogram, with a series for each stage.'''
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, stage, value):
+        series = self._series.get(stage)
+        if series is None:
+            series = self._series[stage] = {
+                'counts': [0] * len(self.buckets),
+                'sum': 0,
+                'count': 0
+            }
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['counts'][index] += 1
+
+        series['sum'] += value
+        series['count'] += 1
+
+    def lines(self):
+        yield '# HELP {0} {1}'.format(self.name, self.description)
+        yield '# TYPE {0} histogram'.format(self.name)
+
+        for stage, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series['counts']):
+                yield '{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(
+                    self.name, stage, bound, count)
+            yield '{0}_bucket{{stage="{1}",le="+Inf"}} {2}'.format(
+                self.name, stage, series['count'])
+            yield '{0}_sum{{stage="{1}"}} {2}'.format(self.name, stage,
+                                                     series['sum'])
+            yield '{0}_count{{stage="{1}"}} {2}'.format(
+                self.name, stage, series['count'])
+
+
+class Registry:
+    '''Aggregates the spans of every render into histograms of durations and
+    attributes by stage.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds = Histogram('coda_stage_seconds',
+                                  'Time spent in each stage of a render.',
+                                  SECONDS_BUCKETS)
+        self._attributes = {
+            name: Histogram('coda_stage_' + name,
+                            'The {0} processed by each stage.'.format(name),
+                            buckets)
+            for name, buckets in ATTRIBUTE_BUCKETS.items()
+        }
+
+    def observe(self, spans):
+        with self._lock:
+            for s in spans:
+                self._seconds.observe(s.stage, s.seconds)
+
+                for name, value in s.attributes.items():
+                    if name in self._attributes:
+                        self._attributes[name].observe(s.stage, value)
+
+    def exposition(self):
+        '''Return the histograms in the Prometheus text format.'''
+        with self._lock:
+            lines = list(self._seconds.lines())
+            for name in sorted(self._attributes):
+                lines.extend(self._attributes[name].lines())
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,437 @@
+import atexit
+import itertools
+import json
+import os
+import re
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pypandoc
+
+from src import limits
+
+# Number of long-lived pandoc servers. Zero disables the pool, so every
+# conversion spawns a pandoc process.
+DEFAULT_POOL_SIZE = 2
+
+# Seconds to wait for a new server to answer its first health check.
+STARTUP_TIMEOUT = 10
+
+HEALTH_CHECK_INTERVAL = 10
+HEALTH_CHECK_TIMEOUT = 2
+
+# Seconds a single conversion may take. Pandoc's server aborts conversions
+# after two seconds by default, which is too short for a large grammar.
+CONVERSION_TIMEOUT = limits.timeout
+
+# Formats which pypandoc accepts under other names than pandoc does.
+FORMAT_ALIASES = {'md': 'markdown', 'tex': 'latex'}
+
+# The earliest pandoc with a server mode.
+SERVER_VERSION = (3, 0)
+
+# Options of pandoc 1, which the renderers use, that pandoc 2.0 renamed.
+RENAMED_OPTIONS = {'--latex-engine': '--pdf-engine'}
+
+_version = None
+
+
+class UnsupportedArguments(Exception):
+    '''The conversion uses a pandoc option which has no equivalent in the
+    server's JSON API.'''
+    pass
+
+
+def server_options(source, format, to, extra_args):
+    '''Translate the arguments of a pypandoc conversion into the options of a
+    pandoc server request. Files named by the arguments are read here, as the
+    server cannot read files itself.
+
+    Raises UnsupportedArguments if an argument cannot be translated.'''
+    options = {
+        'text': source,
+        'from': FORMAT_ALIASES.get(format, format),
+        'to': FORMAT_ALIASES.get(to, to),
+        'variables': {}
+    }
+
+    for argument in extra_args:
+        name, _, value = argument.partition('=')
+
+        if name == '--smart':
+            options['from'] += '+smart'
+        elif name in ['--standalone', '-s']:
+            options['standalone'] = True
+        elif name in ['--toc', '--table-of-contents']:
+            options['table-of-contents'] = True
+        elif name == '--html-q-tags':
+            options['html-q-tags'] = True
+        elif name == '--top-level-division':
+            options['top-level-division'] = value
+        elif name in ['--latex-engine', '--pdf-engine']:
+            # Only used when pandoc writes PDFs itself, which it never does
+            # here.
+            continue
+        elif name == '--template' and os.path.isfile(value):
+            with open(value, encoding='utf-8') as f:
+                options['template'] = f.read()
+        elif name == '--include-in-header' and os.path.isfile(value):
+            # Pandoc itself adds included files to this variable.
+            with open(value, encoding='utf-8') as f:
+                options['variables'].setdefault('header-includes',
+                                                []).append(f.read())
+        elif name == '--variable':
+            key, _, variable = value.partition(':')
+            options['variables'][key] = variable or 'true'
+        else:
+            raise UnsupportedArguments(argument)
+
+    return options
+
+
+def pandoc_version():
+    '''Return the installed pandoc's version as a tuple of integers, or None
+    if pandoc cannot be found.'''
+    global _version
+
+    if _version is None:
+        try:
+            version = pypandoc.get_pandoc_version()
+        except OSError:
+            return None
+
+        _version = tuple(int(x) for x in re.findall(r'\d+', version)[:3])
+
+    return _version
+
+
+def process_arguments(format, extra_args, version):
+    '''Translate the pandoc 1 arguments used by the renderers into those of
+    the given pandoc version, for a conversion run by a pandoc process.
+    Returns the reader format and the arguments.
+
+    Pandoc 2.0 replaced --smart with the smart extension of the reader, and
+    renamed --latex-engine to --pdf-engine.'''
+    if version is None or version[0] < 2:
+        return format, list(extra_args)
+
+    arguments = []
+    for argument in extra_args:
+        name, separator, value = argument.partition('=')
+
+        if name == '--smart':
+            format = FORMAT_ALIASES.get(format, format) + '+smart'
+        else:
+            arguments.append(RENAMED_OPTIONS.get(name, name) + separator +
+                             value)
+
+    return format, arguments
+
+
+def run_pandoc(format, to, arguments, source=None, path=None,
+               outputfile=None):
+    '''Convert a string, or the file at path, with a pandoc process under the
+    CPU time, memory and wall time limits. Returns the output, or None if it
+    was written to outputfile.'''
+    command = [
+        pypandoc.get_pandoc_path(),
+        '--from=' + FORMAT_ALIASES.get(format, format),
+        '--to=' + FORMAT_ALIASES.get(to, to)
+    ] + arguments + limits.pandoc_arguments()
+
+    if outputfile is not None:
+        command.append('--output=' + outputfile)
+    if path is not None:
+        command.append(path)
+
+    # Pandoc's runtime is limited by pandoc_arguments instead of an address
+    # space limit, which it exceeds on start.
+    returncode, output, error = limits.run(
+        command,
+        input=(source or '').encode('utf-8'),
+        limit_memory=False)
+
+    if returncode != 0:
+        raise RuntimeError(
+            'Pandoc died with exitcode "{0}" during conversion: {1}'.format(
+                returncode, error.decode('utf-8', 'replace')))
+
+    if outputfile is None:
+        return output.decode('utf-8')
+
+
+def free_port():
+    '''Return a local port which is not currently in use.'''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class PandocServer:
+    '''A single `pandoc server` process listening on a local port.'''
+
+    def __init__(self, pandoc_path, port):
+        self.pandoc_path = pandoc_path
+        self.port = port
+        self.url = 'http://127.0.0.1:{0}'.format(port)
+        self.process = None
+        self.restarts = 0
+
+    def start(self):
+        '''Start the server and wait until it answers. Returns False if it
+        does not, e.g. because pandoc is older than 3.0 and has no server
+        mode.'''
+        self.process = subprocess.Popen(
+            [
+                self.pandoc_path, 'server', '--port',
+                str(self.port), '--timeout',
+                str(CONVERSION_TIMEOUT)
+            ] + limits.pandoc_arguments(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                return False
+            if self.healthy():
+                return True
+            time.sleep(0.05)
+
+        self.stop()
+        return False
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        return self.start()
+
+    def healthy(self):
+        '''Return True if the server is running and answers a version
+        request.'''
+        try:
+            with urllib.request.urlopen(
+                    self.url + '/version',
+                    timeout=HEALTH_CHECK_TIMEOUT) as response:
+                return response.status == 200
+        except OSError:
+            return False
+
+    def convert(self, options):
+        '''Send a conversion to the server and return its output.'''
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(options).encode('utf-8'),
+            headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json'
+            })
+
+        with urllib.request.urlopen(
+                request, timeout=CONVERSION_TIMEOUT) as response:
+            result = json.loads(response.read().decode('utf-8'))
+
+        if result.get('base64'):
+            raise UnsupportedArguments('binary output format ' + options['to'])
+
+        return result['output']
+
+
+class PandocPool:
+    '''A pool of warm pandoc servers, which convert documents without the cost
+    of starting a pandoc process each time. Servers are health checked in a
+    background thread and restarted if they crash.
+
+    The pool is started by the web server before its render workers start,
+    and each worker attaches to its servers by port. Only the starting
+    process restarts servers, on the same ports. The pool only starts with
+    pandoc 3.0 or later, which has a server mode. If no server can convert a
+    document, or the pool was never started, conversions fall back to
+    running a pandoc process under the limits in src.limits, with their
+    arguments translated for the installed pandoc.'''
+
+    def __init__(self, size=DEFAULT_POOL_SIZE,
+                 health_check_interval=HEALTH_CHECK_INTERVAL):
+        self.size = size
+        self.health_check_interval = health_check_interval
+
+        self._servers = []
+        self._cycle = None
+        self._lock = threading.Lock()
+        self._owner = None
+        self._monitor = None
+
+        self.fallbacks = 0
+
+    def start(self):
+        '''Start the servers and their health checks. Returns the number of
+        servers running, which is zero if pandoc has no server mode.'''
+        if self._owner is not None or self.size <= 0:
+            return len(self._servers)
+
+        self._owner = os.getpid()
+
+        version = pandoc_version()
+        if version is None:
+            print('Could not find pandoc, not starting pandoc servers')
+            return 0
+
+        if version < SERVER_VERSION:
+            print('Pandoc {0} has no server mode, not starting pandoc '
+                  'servers'.format('.'.join(str(x) for x in version)))
+            return 0
+
+        pandoc_path = pypandoc.get_pandoc_path()
+
+        for _ in range(self.size):
+            server = PandocServer(pandoc_path, free_port())
+            if not server.start():
+                print('Could not start pandoc server, falling back to '
+                      'pandoc processes')
+                break
+            self._servers.append(server)
+
+        self._cycle = itertools.cycle(self._servers)
+        atexit.register(self.stop)
+
+        if self._servers:
+            self._monitor = threading.Thread(target=self._check_forever)
+            self._monitor.daemon = True
+            self._monitor.start()
+
+        return len(self._servers)
+
+    def stop(self):
+        for server in self._servers:
+            server.stop()
+
+        self._servers = []
+        self._cycle = None
+
+    def ports(self):
+        '''Return the ports of the servers, for other processes to attach
+        to.'''
+        return [x.port for x in self._servers]
+
+    def attach(self, ports):
+        '''Convert with servers started by another process, listening on the
+        given ports. This process never restarts them.'''
+        self._servers = [PandocServer(None, port) for port in ports]
+        self._cycle = itertools.cycle(self._servers)
+
+    def convert_text(self, source, to, format, extra_args=(),
+                     outputfile=None):
+        '''Convert a string in the same way as pypandoc.convert_text, using a
+        pandoc server if possible.'''
+        output = None
+
+        if self._servers:
+            try:
+                options = server_options(source, format, to, extra_args)
+            except UnsupportedArguments:
+                options = None
+
+            if options is not None:
+                output = self._convert(options)
+
+        if output is None:
+            self.fallbacks += 1
+            format, arguments = process_arguments(format, extra_args,
+                                                  pandoc_version())
+            return run_pandoc(format, to, arguments, source=source,
+                              outputfile=outputfile)
+
+        if outputfile is None:
+            return output
+
+        with open(outputfile, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+    def convert_file(self, path, to, format, extra_args=()):
+        '''Convert a file in the same way as pypandoc.convert_file.'''
+        if not self._servers:
+            self.fallbacks += 1
+            format, arguments = process_arguments(format, extra_args,
+                                                  pandoc_version())
+            return run_pandoc(format, to, arguments, path=path)
+
+        with open(path, encoding='utf-8') as f:
+            return self.convert_text(f.read(), to, format, extra_args)
+
+    def stats(self):
+        return {
+            'servers': len(self._servers),
+            'healthy': sum(1 for x in self._servers
+                           if x.process is not None and
+                           x.process.poll() is None),
+            'restarts': sum(x.restarts for x in self._servers),
+            'fallbacks': self.fallbacks
+        }
+
+    def _convert(self, options):
+        # Try each server once, starting from the next in turn. Advancing
+        # the cycle is atomic, so no lock is needed here.
+        for _ in range(len(self._servers)):
+            server = next(self._cycle)
+
+            try:
+                return server.convert(options)
+            except (urllib.error.HTTPError, UnsupportedArguments) as e:
+                # The server ran but could not convert the document.
+                # Converting again with a pandoc process gives the usual
+                # error message.
+                print('Pandoc server could not convert: ' + str(e))
+                return None
+            except (OSError, ValueError):
+                if os.getpid() == self._owner:
+                    self._restart(server)
+
+        return None
+
+    def _restart(self, server):
+        with self._lock:
+            if not server.healthy():
+                print('Restarting pandoc server on port {0}'.format(
+                    server.port))
+                server.restart()
+
+    def _check_forever(self):
+        while True:
+            time.sleep(self.health_check_interval)
+
+            for server in self._servers:
+                if not server.healthy():
+                    self._restart(server)
+
+
+pool = PandocPool(
+    size=int(os.environ.get('CODA_PANDOC_SERVERS', DEFAULT_POOL_SIZE)))
+
+
+def attach(ports):
+    '''Attach the shared pandoc pool to servers started by another process.
+    Used as the initializer of render worker processes.'''
+    pool.attach(ports)
+
+
+def convert_text(source, to, format, extra_args=(), outputfile=None):
+    '''Convert a string with the shared pandoc pool.'''
+    return pool.convert_text(
+        source, to, format, extra_args=extra_args, outputfile=outputfile)
+
+
+def convert_file(path, to, format, extra_args=()):
+    '''Convert a file with the shared pandoc pool.'''
+    return pool.convert_file(path, to, format, extra_args=extra_args)
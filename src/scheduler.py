@@ -0,0 +1,192 @@
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+PDF = 'pdf'
+HTML = 'html'
+
+# Seconds a build of each kind is assumed to take before any has finished,
+# used to estimate when a saturated queue will have room.
+DEFAULT_DURATIONS = {PDF: 30, HTML: 5}
+
+# Weight of the latest build in the moving average of build durations.
+DURATION_WEIGHT = 0.2
+
+
+def job_kind(settings):
+    '''Return PDF if a render request includes a PDF, which needs far more
+    time and memory than HTML, and HTML otherwise.'''
+    output_formats = [x.strip() for x in settings['format'].split(',')]
+
+    return PDF if 'LaTeX PDF' in output_formats else HTML
+
+
+def default_limits(workers):
+    '''Return the default (running, queued) limits of each kind of build for
+    the given number of worker processes. At most half of the workers build
+    PDFs, so HTML builds are never stuck behind them.'''
+    return {
+        PDF: (max(1, workers // 2), 4 * workers),
+        HTML: (workers, 8 * workers)
+    }
+
+
+class Saturated(Exception):
+    '''A build was refused because its queue is full.'''
+
+    def __init__(self, kind, retry_after):
+        super().__init__(
+            'The server is busy with other {0} builds. Please try again in '
+            '{1} seconds.'.format(kind.upper(), retry_after))
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+class Scheduler:
+    '''Admits builds to an executor, running at most a fixed number of each
+    kind at once. Further builds wait in a bounded queue for their kind, and
+    builds beyond that are refused with Saturated, which estimates when to
+    try again.
+
+    The executor is made by calling executor_factory when the first build
+    starts, so that it sees any state set up before then. If a worker process
+    dies, e.g. killed for running out of memory, the builds it broke fail
+    and the executor is replaced, so later builds still run.
+
+    limits is a dictionary of kind to a (running, queued) pair.'''
+
+    def __init__(self, executor_factory, limits):
+        self.executor_factory = executor_factory
+        self.executor = None
+        self.limits = limits
+
+        self._lock = threading.Lock()
+        self._running = {kind: 0 for kind in limits}
+        self._queues = {kind: deque() for kind in limits}
+        self._durations = {
+            kind: DEFAULT_DURATIONS.get(kind, DEFAULT_DURATIONS[PDF])
+            for kind in limits
+        }
+
+        self.rejections = 0
+        self.replacements = 0
+
+    def submit(self, kind, fn, *args):
+        '''Run fn(*args) in the executor once a build of the kind can start,
+        and return a future for its result. The future is running once the
+        build has left the queue.'''
+        future = Future()
+        max_running, max_queued = self.limits[kind]
+
+        with self._lock:
+            if self._running[kind] < max_running:
+                self._running[kind] += 1
+            elif len(self._queues[kind]) < max_queued:
+                self._queues[kind].append((future, fn, args))
+                return future
+            else:
+                self.rejections += 1
+                raise Saturated(kind, self._retry_after(kind))
+
+        self._dispatch(kind, future, fn, args)
+
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': dict(self._running),
+                'queued': {
+                    kind: len(queue)
+                    for kind, queue in self._queues.items()
+                },
+                'durations': {
+                    kind: round(seconds, 2)
+                    for kind, seconds in self._durations.items()
+                },
+                'rejections': self.rejections,
+                'replacements': self.replacements
+            }
+
+    def _retry_after(self, kind):
+        # The time for the builds ahead of a new one to finish, if they run
+        # at the kind's average duration.
+        max_running, _ = self.limits[kind]
+        waiting = len(self._queues[kind]) + 1
+
+        return max(1, math.ceil(
+            self._durations[kind] * waiting / max(1, max_running)))
+
+    def _dispatch(self, kind, future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            self._release(kind, None)
+            return
+
+        start = time.time()
+        executor = self._current_executor()
+
+        try:
+            try:
+                inner = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died after the last build finished.
+                self._replace(executor)
+                executor = self.executor
+                inner = executor.submit(fn, *args)
+        except Exception as e:
+            self._release(kind, None)
+            future.set_exception(e)
+            return
+
+        inner.add_done_callback(lambda f: self._finish(
+            kind, future, f, time.time() - start, executor))
+
+    def _finish(self, kind, future, inner, seconds, executor):
+        error = inner.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._replace(executor)
+
+        # Start the next build before handing over the result, so the slot
+        # is not idle while the result is handled.
+        self._release(kind, seconds)
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(inner.result())
+
+    def _current_executor(self):
+        with self._lock:
+            if self.executor is None:
+                self.executor = self.executor_factory()
+
+            return self.executor
+
+    def _replace(self, broken):
+        '''Replace a broken executor, unless it has been replaced already.'''
+        with self._lock:
+            if self.executor is not broken:
+                return
+
+            self.executor = self.executor_factory()
+            self.replacements += 1
+
+        print('A render worker died, starting a new worker pool')
+        broken.shutdown(wait=False)
+
+    def _release(self, kind, seconds):
+        with self._lock:
+            if seconds is not None:
+                self._durations[kind] += DURATION_WEIGHT * (
+                    seconds - self._durations[kind])
+
+            if not self._queues[kind]:
+                self._running[kind] -= 1
+                return
+
+            queued = self._queues[kind].popleft()
+
+        self._dispatch(kind, *queued)
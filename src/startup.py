@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+
+import pypandoc
+
+from src.compression import variants
+from src.generate import (LATEX_LAYOUTS, dictionary_template,
+                          latex_template_directory, render, split_template,
+                          temp_directory, theme_registry)
+from src.pandoc import pool as pandoc_pool
+
+STARTING = 'starting'
+READY = 'ready'
+FAILED = 'failed'
+
+# A tiny grammar using every feature of Coda's markdown, rendered once in
+# each format so that the first real request finds pandoc, the filters,
+# xelatex, the LaTeX formats and the font cache already warm.
+WARM_UP_MARKDOWN = '''# Warm-up
+
+(@) kala bor, water drink, I drink water
+
+(*) Rule: a rule
+
+A reference to `kala`.
+'''
+
+WARM_UP_LEXICON = '''word,local,pronunciation,part of speech,,definition
+kala,water,kala,noun,,water
+bor,drink,bor,verb,,to drink
+'''
+
+WARM_UP_SETTINGS = {
+    'grammarTitle': 'Warm-up',
+    'grammarSubtitle': 'A grammar',
+    'author': 'Coda',
+    'theme': 'Default',
+    'layout': 'A4'
+}
+
+
+def check_pandoc():
+    '''Check that pandoc is installed, downloading it if it is not.'''
+    print('Looking for pandoc...')
+
+    try:
+        version = pypandoc.get_pandoc_version()
+        print('Found version {0}'.format(version))
+
+    except OSError:
+        print('Not found! Downloading...')
+
+        pypandoc.pandoc_download.download_pandoc()
+
+        print('Download complete!')
+
+
+def start_pandoc_servers():
+    pandoc_pool.start()
+
+
+def validate_templates():
+    '''Build each HTML theme's header bundle, and check that the LaTeX
+    templates can be read and filled in.'''
+    theme_registry.preload()
+
+    split_template(dictionary_template(), 'definitions')
+
+    with open(os.path.join(latex_template_directory, 'Default.tex'),
+              encoding='utf-8') as f:
+        if '$body$' not in f.read():
+            raise Exception('Default.tex has no $body$ placeholder')
+
+
+def warm_up_render(settings):
+    '''Render the warm-up grammar and remove the result.'''
+    filename = render([WARM_UP_MARKDOWN], WARM_UP_LEXICON,
+                      dict(WARM_UP_SETTINGS, **settings))
+
+    for path in variants(os.path.join(temp_directory, filename)):
+        os.remove(path)
+
+
+def warm_up_html():
+    warm_up_render({'format': 'HTML'})
+
+
+def warm_up_pdf():
+    # Each layout has its own precompiled preamble.
+    for layout in LATEX_LAYOUTS:
+        warm_up_render({'format': 'LaTeX PDF', 'layout': layout})
+
+
+# Each step is a (name, function, required) tuple. The server is not ready
+# if a required step fails. PDF output is optional, so the server can still
+# render HTML without a TeX distribution.
+#
+# The blocking steps run before the first request is handled. The pandoc
+# servers must be running before the first request starts the render
+# workers, so that the workers attach to them.
+BLOCKING_STEPS = [
+    ('pandoc', check_pandoc, True),
+    ('pandoc_servers', start_pandoc_servers, False),
+]
+
+DEFAULT_STEPS = [
+    ('templates', validate_templates, True),
+    ('html', warm_up_html, True),
+    ('pdf', warm_up_pdf, False),
+]
+
+
+class Startup:
+    '''Runs the server's blocking steps, then its warm-up steps in a
+    background thread, so the server can answer health checks while it warms
+    up, and reports whether it is ready to serve renders at their usual
+    speed.'''
+
+    def __init__(self, steps=DEFAULT_STEPS, blocking_steps=BLOCKING_STEPS):
+        self.steps = steps
+        self.blocking_steps = blocking_steps
+        self.state = STARTING
+        self.results = []
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def start(self):
+        '''Run the blocking steps, then start the warm-up thread unless a
+        required blocking step failed. Does nothing if this process has
+        already started, and other callers wait until the blocking steps are
+        done.'''
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+
+            if not self._run_steps(self.blocking_steps):
+                return
+
+            self._thread = threading.Thread(target=self.run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def run(self):
+        if self._run_steps(self.steps):
+            self.state = READY
+
+    def _run_steps(self, steps):
+        '''Run each step in order, stopping at the first required step which
+        fails. Returns whether every required step succeeded.'''
+        for name, function, required in steps:
+            start = time.perf_counter()
+            error = None
+
+            try:
+                function()
+            except Exception as e:
+                error = str(type(e).__name__) + ': ' + str(e)
+                print('Warm-up step {0} failed: {1}'.format(name, error))
+
+            self.results.append({
+                'step': name,
+                'seconds': round(time.perf_counter() - start, 3),
+                'error': error
+            })
+
+            if error is not None and required:
+                self.state = FAILED
+                return False
+
+        return True
+
+    def as_dict(self):
+        return {'status': self.state, 'steps': list(self.results)}
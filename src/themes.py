@@ -0,0 +1,197 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+
+# Files shared by every HTML theme, which wrap the theme's stylesheet. They
+# are included in this order: the theme's HTML, before.html, the theme's CSS
+# and after.html.
+BEFORE_FILE = 'before.html'
+AFTER_FILE = 'after.html'
+
+# Matches a style or script element, so that its contents can be minified as
+# CSS or JavaScript rather than as HTML.
+EMBEDDED_BLOCK = re.compile(r'(<(style|script)\b[^>]*>)(.*?)(</\2>)',
+                            re.I | re.S)
+
+COMMENT = re.compile(r'/\*.*?\*/', re.S)
+HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.S)
+CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+DECLARATION_COLON = re.compile(r':\s+')
+
+
+def import_sass():
+    '''Return the optional sass (libsass) module, or None if it is not
+    installed. It is only imported when a bundle is built, which is rare.'''
+    try:
+        import sass
+    except ImportError:
+        return None
+
+    return sass
+
+
+def minify_css(css):
+    '''Remove comments and unnecessary whitespace from a stylesheet.'''
+    css = COMMENT.sub('', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = CSS_PUNCTUATION.sub(r'\1', css)
+    css = DECLARATION_COLON.sub(':', css)
+
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    '''Remove block comments, indentation and blank lines from a script.
+    Line breaks are kept, so that statements without semicolons still
+    work.'''
+    js = COMMENT.sub('', js)
+    lines = (line.strip() for line in js.split('\n'))
+
+    return '\n'.join(line for line in lines if line)
+
+
+def minify_html(html):
+    '''Minify an HTML fragment, minifying embedded styles and scripts as CSS
+    and JavaScript.'''
+    parts = []
+    position = 0
+
+    for match in EMBEDDED_BLOCK.finditer(html):
+        parts.append(minify_markup(html[position:match.start()]))
+
+        opening, tag, content, closing = match.groups()
+        if tag.lower() == 'style':
+            content = minify_css(content)
+        else:
+            content = minify_js(content)
+
+        parts.append(opening + content + closing)
+        position = match.end()
+
+    parts.append(minify_markup(html[position:]))
+
+    return ''.join(parts)
+
+
+def minify_markup(html):
+    html = HTML_COMMENT.sub('', html)
+    html = re.sub(r'>\s+<', '><', html)
+
+    return re.sub(r'\s+', ' ', html).strip()
+
+
+class ThemeRegistry:
+    '''Builds a single, minified header bundle for each HTML theme, which is
+    included in the output instead of the theme's separate files. Themes
+    written in SCSS are compiled if the optional sass (libsass) module is
+    installed; otherwise the theme's precompiled CSS is used.
+
+    Bundles are kept in memory and in a directory on disk, named after a
+    digest of the theme's sources, so each version of a theme is only built
+    once. Any change to a file in the theme directory rebuilds the bundle.'''
+
+    def __init__(self, theme_directory, bundle_directory):
+        self.theme_directory = theme_directory
+        self.bundle_directory = bundle_directory
+
+        self._lock = threading.Lock()
+        self._bundles = {}
+
+    def themes(self):
+        '''Return the names of the available themes.'''
+        return sorted(
+            os.path.splitext(filename)[0]
+            for filename in os.listdir(self.theme_directory)
+            if filename.endswith('.html')
+            and filename not in [BEFORE_FILE, AFTER_FILE])
+
+    def bundle(self, theme):
+        '''Return the path of the theme's header bundle, building it if the
+        theme has changed since it was last built.'''
+        if theme not in self.themes():
+            raise Exception('Unknown theme: ' + str(theme))
+
+        signature = self._signature()
+
+        with self._lock:
+            cached = self._bundles.get(theme)
+            if cached is not None and cached[0] == signature:
+                return cached[1]
+
+            path = self._build(theme)
+            self._bundles[theme] = (signature, path)
+
+        return path
+
+    def preload(self):
+        '''Build the bundle of every theme.'''
+        for theme in self.themes():
+            self.bundle(theme)
+
+    def _signature(self):
+        # The modification time and size of every file in the theme
+        # directory, which is much cheaper to check than the contents.
+        signature = []
+        for filename in sorted(os.listdir(self.theme_directory)):
+            stat = os.stat(os.path.join(self.theme_directory, filename))
+            signature.append((filename, stat.st_mtime_ns, stat.st_size))
+
+        return signature
+
+    def _sources(self, theme):
+        '''Return the theme's sources as a list of (kind, filename)
+        pairs.'''
+        stylesheet = ('scss', theme + '.scss')
+        if import_sass() is None or not os.path.exists(
+                os.path.join(self.theme_directory, stylesheet[1])):
+            stylesheet = ('css', theme + '.css')
+
+        return [('html', theme + '.html'), ('html', BEFORE_FILE), stylesheet,
+                ('html', AFTER_FILE)]
+
+    def _build(self, theme):
+        sources = self._sources(theme)
+
+        # Name the bundle after all of the theme directory's files, which
+        # include any SCSS partials the stylesheet imports.
+        digest = hashlib.sha256()
+        for filename in sorted(os.listdir(self.theme_directory)):
+            digest.update(filename.encode() + b'\0')
+            with open(os.path.join(self.theme_directory, filename), 'rb') as f:
+                digest.update(f.read())
+        digest.update(repr(sources).encode())
+
+        path = os.path.join(self.bundle_directory, '{0}-{1}.html'.format(
+            theme,
+            digest.hexdigest()[:16]))
+
+        if os.path.exists(path):
+            return path
+
+        parts = []
+        for kind, filename in sources:
+            source_path = os.path.join(self.theme_directory, filename)
+
+            if kind == 'scss':
+                parts.append(
+                    import_sass().compile(
+                        filename=source_path,
+                        include_paths=[self.theme_directory]))
+            else:
+                with open(source_path, encoding='utf-8') as f:
+                    parts.append(f.read())
+
+        # The shared files open and close a style element around the
+        # stylesheet, so the parts are minified together.
+        bundle = minify_html('\n'.join(parts))
+
+        os.makedirs(self.bundle_directory, exist_ok=True)
+
+        partial = '{0}.{1}.partial'.format(path, uuid.uuid4().hex)
+        with open(partial, 'w', encoding='utf-8') as f:
+            f.write(bundle)
+        os.replace(partial, path)
+
+        return path
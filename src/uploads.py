@@ -0,0 +1,136 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from src.chapters import MarkdownFile
+from src.lexicon import LexiconFile
+
+# Extensions of uploads which are unpacked into chapters and a lexicon.
+ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2']
+
+# Extensions of archive members which are read as chapters. Other members,
+# such as images or notes, are ignored.
+CHAPTER_EXTENSIONS = ['.md', '.markdown', '.mdown', '.txt']
+
+LEXICON_EXTENSION = '.csv'
+
+# Limit on the total size of the files unpacked from a single request, so
+# that a small compressed archive cannot fill the disk.
+MAX_UNPACKED_BYTES = 512 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Uploads:
+    '''The chapters and lexicon of a request, spooled to a directory on disk.
+    The directory should be removed once the render has finished.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.chapters = []
+        self.lexicon = None
+        self.unpacked_bytes = 0
+        self._count = 0
+
+    def path(self, extension):
+        '''Return a new path in the upload directory. Paths are numbered in
+        order rather than named after the upload, so a member name can never
+        escape the directory.'''
+        self._count += 1
+        return os.path.join(self.directory, '{0:04d}{1}'.format(
+            self._count, extension))
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def is_archive(filename):
+    return filename.lower().endswith(tuple(ARCHIVE_EXTENSIONS))
+
+
+def spool_uploads(files, directory, max_unpacked_bytes=MAX_UNPACKED_BYTES):
+    '''Save uploaded files, given as (filename, file storage) pairs, to a new
+    directory under the given directory, without reading them into memory.
+
+    A file ending in .csv is the lexicon and any other file is a chapter, in
+    the order uploaded. Archives are unpacked in their place: their chapters
+    are ordered by member name, e.g. 01-phonology.md, 02-morphology.md, and
+    the CSV member is the lexicon. If there is more than one lexicon, the
+    last is used.
+
+    Returns an Uploads.'''
+    uploads = Uploads(tempfile.mkdtemp(prefix='upload-', dir=directory))
+
+    try:
+        for filename, blob in files:
+            if is_archive(filename):
+                archive_path = os.path.join(uploads.directory, 'archive')
+                blob.save(archive_path)
+                unpack_archive(uploads, filename, archive_path,
+                               max_unpacked_bytes)
+                os.remove(archive_path)
+
+            elif filename.lower().endswith(LEXICON_EXTENSION):
+                path = uploads.path(LEXICON_EXTENSION)
+                blob.save(path)
+                uploads.lexicon = LexiconFile(path)
+
+            else:
+                path = uploads.path('.md')
+                blob.save(path)
+                uploads.chapters.append(MarkdownFile(path, name=filename))
+    except Exception:
+        uploads.remove()
+        raise
+
+    return uploads
+
+
+def unpack_archive(uploads, filename, archive_path, max_unpacked_bytes):
+    '''Unpack the chapters and lexicon of a zip or tar archive, one member at
+    a time.'''
+    if filename.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            members = [(x.filename, x) for x in archive.infolist()
+                       if not x.is_dir()]
+            unpack_members(uploads, sorted(members, key=lambda x: x[0]),
+                           archive.open, max_unpacked_bytes)
+    else:
+        with tarfile.open(archive_path, 'r:*') as archive:
+            members = [(x.name, x) for x in archive.getmembers()
+                       if x.isfile()]
+            unpack_members(uploads, sorted(members, key=lambda x: x[0]),
+                           archive.extractfile, max_unpacked_bytes)
+
+
+def unpack_members(uploads, members, open_member, max_unpacked_bytes):
+    for name, member in members:
+        basename = os.path.basename(name)
+
+        # Skip hidden files and the resource forks added by macOS.
+        if basename.startswith('.') or name.startswith('__MACOSX/'):
+            continue
+
+        extension = os.path.splitext(basename)[1].lower()
+        if extension == LEXICON_EXTENSION:
+            path = uploads.path(LEXICON_EXTENSION)
+        elif extension in CHAPTER_EXTENSIONS:
+            path = uploads.path('.md')
+        else:
+            continue
+
+        with open_member(member) as source, open(path, 'wb') as f:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                uploads.unpacked_bytes += len(chunk)
+                if uploads.unpacked_bytes > max_unpacked_bytes:
+                    raise Exception(
+                        'Archive is too large! It must unpack to at most '
+                        '{0} MB.'.format(max_unpacked_bytes // 1024 // 1024))
+                f.write(chunk)
+
+        if extension == LEXICON_EXTENSION:
+            uploads.lexicon = LexiconFile(path)
+        else:
+            uploads.chapters.append(MarkdownFile(path, name=name))
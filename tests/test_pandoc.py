@@ -0,0 +1,55 @@
+import pypandoc
+
+from src import limits, pandoc
+
+
+def run_command(monkeypatch, version, *args, **kwargs):
+    '''Run a fallback conversion and return the pandoc command it ran.'''
+    commands = []
+
+    def run(command, input=None, cwd=None, limit_memory=True):
+        commands.append(command)
+        return 0, b'', b''
+
+    monkeypatch.setattr(limits, 'run', run)
+    monkeypatch.setattr(pypandoc, 'get_pandoc_path', lambda: 'pandoc')
+    monkeypatch.setattr(pandoc, '_version', version)
+
+    pandoc.PandocPool(size=0).convert_text(*args, **kwargs)
+
+    return commands[0]
+
+
+def test_latex_writer_format(monkeypatch):
+    command = run_command(monkeypatch, (3, 1), '{}', 'tex', 'json',
+                          outputfile='grammar.tex')
+
+    assert command[:3] == ['pandoc', '--from=json', '--to=latex']
+    assert command[-1] == '--output=grammar.tex'
+
+
+def test_pandoc_1_arguments(monkeypatch):
+    command = run_command(monkeypatch, (1, 19), '# Title', 'json', 'md',
+                          ['--smart', '--latex-engine=xelatex'])
+
+    assert command[:5] == [
+        'pandoc', '--from=markdown', '--to=json', '--smart',
+        '--latex-engine=xelatex'
+    ]
+
+
+def test_pandoc_2_arguments(monkeypatch):
+    command = run_command(monkeypatch, (2, 19), '# Title', 'json', 'md',
+                          ['--smart', '--latex-engine=xelatex'])
+
+    assert command[:4] == [
+        'pandoc', '--from=markdown+smart', '--to=json',
+        '--pdf-engine=xelatex'
+    ]
+
+
+def test_server_options_formats():
+    options = pandoc.server_options('{}', 'json', 'tex', [])
+
+    assert options['from'] == 'json'
+    assert options['to'] == 'latex'